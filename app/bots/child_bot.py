@@ -1,107 +1,107 @@
 from __future__ import annotations
 
-import asyncio
-from typing import Optional
+import logging
 
 from aiogram import Router, F, Bot
 from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import (
     Message, CallbackQuery, ChatJoinRequest, ChatMemberUpdated,
     InlineKeyboardMarkup, InlineKeyboardButton,
 )
 from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
-from aiogram.enums import ParseMode
 
 from app.bots.common import (
-    child_admin_kb, child_settings_kb,
+    child_admin_kb, child_settings_kb, stats_range_kb, broadcast_kb,
 )
-from app.services.greetings_simple import get_greeting   # НЕ импортируем save_greeting
+from app.bots.middlewares.tenant_ctx import current_tenant
+from app.services.greetings_simple import SendPlan, get_greeting, get_send_plan   # НЕ импортируем save_greeting
 from app.services.settings_simple import get_collect_requests, toggle_collect_requests
-from app.services.pending import add_request, list_new, mark_approved, mark_failed
+from app.services.pending import add_request, iter_new
+from app.services.approvals import approve_pending
+from app.services import stats, broadcast
 
 router = Router()
+log = logging.getLogger(__name__)
+
+
+class BroadcastStates(StatesGroup):
+    waiting_message = State()
 
 # ====== helpers ======
 
-def _tenant_id_from_bot(bot: Bot) -> int:
-    # middleware кладёт сюда словарь: {"id": t.id, "owner_user_id": ...}
-    t = getattr(bot, "_tenant", None)
+def _tenant_id() -> int:
+    # middleware выставляет словарь текущего апдейта: {"id": t.id, "owner_user_id": ...}
+    t = current_tenant.get()
     if not t or "id" not in t:
         raise RuntimeError("Tenant context is missing. Check TenantContext middleware.")
     return int(t["id"])
 
+def _is_owner(user_id: int) -> bool:
+    # рассылка и статистика — только владельцу бота, не любому, кто написал /admin
+    t = current_tenant.get()
+    return bool(t) and t.get("owner_user_id") == user_id
+
 async def _send_dm_greeting(bot: Bot, user_id: int, tenant_id: int, kind: str = "hello") -> bool:
     """
     Пытаемся отправить ЛС с приветствием/прощанием.
     Возвращаем True при успехе, False если нельзя (403 и т.п.) или нет настроек.
     НИЧЕГО в чаты/каналы не отправляем.
     """
-    g = await get_greeting(tenant_id, kind)
-    if not g:
+    plan = await get_send_plan(tenant_id, kind)
+    if not plan:
         return False
 
-    text = g.get("text") or ""
-    parse_mode = g.get("parse_mode") or None
-    button_text = g.get("button_text")
-    button_url = g.get("button_url")
-    disable_preview = bool(g.get("disable_preview") or False)
+    delivered = await _deliver(bot, user_id, plan)
+    stats.record_dm(tenant_id, delivered)
+    return delivered
 
-    kb: Optional[InlineKeyboardMarkup] = None
-    if button_text and button_url:
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=button_text, url=button_url)]
-        ])
 
+async def _deliver(bot: Bot, user_id: int, plan: SendPlan) -> bool:
     try:
-        # Медиа приоритет: фото > видео > кружок > просто текст
-        if g.get("photo_file_id"):
+        if plan.method == "photo":
             await bot.send_photo(
                 chat_id=user_id,
-                photo=g["photo_file_id"],
-                caption=text or None,
-                parse_mode=parse_mode or ParseMode.MARKDOWN,
-                reply_markup=kb,
+                photo=plan.media_id,
+                caption=plan.text,
+                parse_mode=plan.parse_mode,
+                reply_markup=plan.reply_markup,
                 has_spoiler=False,
             )
-            return True
-        if g.get("video_file_id"):
+        elif plan.method == "video":
             await bot.send_video(
                 chat_id=user_id,
-                video=g["video_file_id"],
-                caption=text or None,
-                parse_mode=parse_mode or ParseMode.MARKDOWN,
-                reply_markup=kb,
+                video=plan.media_id,
+                caption=plan.text,
+                parse_mode=plan.parse_mode,
+                reply_markup=plan.reply_markup,
                 supports_streaming=True
             )
-            return True
-        if g.get("video_note_file_id"):
+        elif plan.method == "video_note":
             await bot.send_video_note(
                 chat_id=user_id,
-                video_note=g["video_note_file_id"],
-                reply_markup=kb,
+                video_note=plan.media_id,
+                reply_markup=plan.reply_markup,
             )
-            if text:
+            if plan.text:
                 await bot.send_message(
                     chat_id=user_id,
-                    text=text,
-                    parse_mode=parse_mode or ParseMode.MARKDOWN,
-                    reply_markup=kb,
-                    disable_web_page_preview=disable_preview,
+                    text=plan.text,
+                    parse_mode=plan.parse_mode,
+                    reply_markup=plan.reply_markup,
+                    disable_web_page_preview=plan.disable_preview,
                 )
-            return True
-
-        # Просто текст
-        if text:
+        else:
+            # Просто текст
             await bot.send_message(
                 chat_id=user_id,
-                text=text,
-                parse_mode=parse_mode or ParseMode.MARKDOWN,
-                reply_markup=kb,
-                disable_web_page_preview=disable_preview,
+                text=plan.text,
+                parse_mode=plan.parse_mode,
+                reply_markup=plan.reply_markup,
+                disable_web_page_preview=plan.disable_preview,
             )
-            return True
-
-        return False
+        return True
 
     except TelegramForbiddenError:
         # Пользователь не открывал ЛС/заблокировал — молчим
@@ -115,7 +115,7 @@ async def _send_dm_greeting(bot: Bot, user_id: int, tenant_id: int, kind: str =
 
 @router.message(Command("admin"))
 async def child_admin_menu(msg: Message, bot: Bot):
-    tenant_id = _tenant_id_from_bot(bot)
+    tenant_id = _tenant_id()
     collect = await get_collect_requests(tenant_id)
     await msg.answer(
         "Админ-меню\n\n"
@@ -128,7 +128,7 @@ async def child_admin_menu(msg: Message, bot: Bot):
 
 @router.callback_query(F.data == "child:home")
 async def cb_child_home(cb: CallbackQuery, bot: Bot):
-    tenant_id = _tenant_id_from_bot(bot)
+    tenant_id = _tenant_id()
     collect = await get_collect_requests(tenant_id)
     await cb.message.edit_text(
         "Админ-меню\n\n"
@@ -157,7 +157,7 @@ async def cb_child_chats(cb: CallbackQuery):
 
 @router.callback_query(F.data == "child:settings")
 async def cb_child_settings(cb: CallbackQuery, bot: Bot):
-    tenant_id = _tenant_id_from_bot(bot)
+    tenant_id = _tenant_id()
     collect = await get_collect_requests(tenant_id)
     await cb.message.edit_text(
         "⚙️ Настройки\n\n"
@@ -171,7 +171,7 @@ async def cb_child_settings(cb: CallbackQuery, bot: Bot):
 
 @router.callback_query(F.data == "child:settings:collect_toggle")
 async def cb_child_collect_toggle(cb: CallbackQuery, bot: Bot):
-    tenant_id = _tenant_id_from_bot(bot)
+    tenant_id = _tenant_id()
     new_value = await toggle_collect_requests(tenant_id)
     await cb.message.edit_text(
         "⚙️ Настройки\n\n"
@@ -185,29 +185,116 @@ async def cb_child_collect_toggle(cb: CallbackQuery, bot: Bot):
 
 @router.callback_query(F.data == "child:settings:collect_run")
 async def cb_child_collect_run(cb: CallbackQuery, bot: Bot):
-    tenant_id = _tenant_id_from_bot(bot)
+    tenant_id = _tenant_id()
     await cb.answer("Запускаю сбор заявок…", show_alert=False)
 
-    rows = await list_new(tenant_id, limit=2000)
-    ok, fail = 0, 0
+    # весь накопленный хвост за один запуск, потоково
+    try:
+        ok, fail = await approve_pending(
+            bot, tenant_id, iter_new(tenant_id),
+            send_dm=lambda user_id: _send_dm_greeting(bot, user_id, tenant_id, kind="hello"),
+        )
+    except Exception:
+        log.exception("collect run failed for tenant %s", tenant_id)
+        return await cb.message.answer("Сбор прерван из-за ошибки. Необработанные заявки остались — запустите ещё раз.")
 
-    for r in rows:
-        row_id = r["id"]
-        chat_id = int(r["chat_id"])
-        user_id = int(r["user_id"])
+    await cb.message.answer(f"Сбор завершён:\n✅ Одобрено: {ok}\n⚠️ Ошибок: {fail}")
+    await cb.answer()
 
-        try:
-            await bot.approve_chat_join_request(chat_id=chat_id, user_id=user_id)
-            delivered = await _send_dm_greeting(bot, user_id, tenant_id, kind="hello")
-            await mark_approved(row_id, dm_ok=delivered, error=None)
-            ok += 1
-        except Exception as e:
-            await mark_failed(row_id, error=str(e)[:300])
-            fail += 1
 
-        await asyncio.sleep(0.15)
+# ====== Рассылка ======
 
-    await cb.message.answer(f"Сбор завершён:\n✅ Одобрено: {ok}\n⚠️ Ошибок: {fail}")
+_BC_STATUS = {"running": "идёт", "done": "завершена", "cancelled": "остановлена", "failed": "прервана ошибкой"}
+
+async def _show_broadcast(message: Message, tenant_id: int) -> None:
+    p = await broadcast.get_progress(tenant_id)
+    lines = ["📰 Рассылка", ""]
+    if p:
+        lines.append(f"Последняя: {_BC_STATUS.get(p['status'], p['status'])}")
+        lines.append(f"✅ Отправлено: {p['sent']}")
+        lines.append(f"⚠️ Ошибок: {p['failed']}")
+        lines.append(f"🚫 Заблокировали бота: {p['blocked']}")
+        if p["status"] == "running":
+            lines.append(f"⏳ Осталось: {p['remaining']}")
+    else:
+        lines.append("Рассылок ещё не было.")
+    running = bool(p and p["status"] == "running")
+    await message.edit_text("\n".join(lines), reply_markup=broadcast_kb(running))
+
+
+@router.callback_query(F.data == "child:broadcast")
+async def cb_child_broadcast(cb: CallbackQuery):
+    if not _is_owner(cb.from_user.id):
+        return await cb.answer()
+    await _show_broadcast(cb.message, _tenant_id())
+    await cb.answer()
+
+
+@router.callback_query(F.data == "child:broadcast:new")
+async def cb_child_broadcast_new(cb: CallbackQuery, state: FSMContext):
+    if not _is_owner(cb.from_user.id):
+        return await cb.answer()
+    await state.set_state(BroadcastStates.waiting_message)
+    await cb.message.answer(
+        "Пришлите сообщение для рассылки (текст, фото, видео — как есть).\n"
+        "Оно будет скопировано всем, кто подавал заявку. /cancel — отмена."
+    )
+    await cb.answer()
+
+
+@router.message(BroadcastStates.waiting_message, Command("cancel"))
+async def child_broadcast_abort(msg: Message, state: FSMContext):
+    await state.clear()
+    await msg.answer("Рассылка отменена.", reply_markup=child_admin_kb())
+
+
+@router.message(BroadcastStates.waiting_message)
+async def child_broadcast_message(msg: Message, bot: Bot, state: FSMContext):
+    tenant_id = _tenant_id()
+    await state.clear()
+    if not _is_owner(msg.from_user.id):
+        return
+    bc_id = await broadcast.start_broadcast(bot, tenant_id, msg.chat.id, msg.message_id)
+    if bc_id is None:
+        return await msg.answer("Рассылка уже идёт — дождитесь окончания или остановите её.")
+    await msg.answer("Рассылка запущена. Прогресс — в меню «📰 Рассылка».", reply_markup=broadcast_kb(True))
+
+
+@router.callback_query(F.data == "child:broadcast:cancel")
+async def cb_child_broadcast_cancel(cb: CallbackQuery):
+    if not _is_owner(cb.from_user.id):
+        return await cb.answer()
+    tenant_id = _tenant_id()
+    stopped = await broadcast.cancel_broadcast(tenant_id)
+    await _show_broadcast(cb.message, tenant_id)
+    await cb.answer("Рассылка остановлена" if stopped else "Нет активной рассылки")
+
+
+# ====== Статистика ======
+
+@router.callback_query(F.data.regexp(r"^child:stats(:\d+)?$"))
+async def cb_child_stats(cb: CallbackQuery):
+    if not _is_owner(cb.from_user.id):
+        return await cb.answer()
+    tenant_id = _tenant_id()
+    parts = cb.data.split(":")
+    days = min(int(parts[2]), 366) if len(parts) > 2 else 7
+
+    t = await stats.range_totals(tenant_id, days)
+    lines = [
+        f"📊 Статистика за {days} дн.",
+        "",
+        f"Заявок: {t['joins']}",
+        f"Одобрено: {t['approvals']}",
+        f"Вышло: {t['leaves']}",
+        f"ЛС доставлено: {t['dm_ok']} / не доставлено: {t['dm_failed']}",
+    ]
+    if days <= 7:
+        lines.append("")
+        for day, d in await stats.daily_series(tenant_id, days):
+            lines.append(f"{day}: +{d['joins']} / ✅{d['approvals']} / −{d['leaves']}")
+
+    await cb.message.edit_text("\n".join(lines), reply_markup=stats_range_kb("child:stats", days, "child:home"))
     await cb.answer()
 
 
@@ -215,7 +302,7 @@ async def cb_child_collect_run(cb: CallbackQuery, bot: Bot):
 
 @router.callback_query(F.data.startswith("child:greet:"))
 async def cb_child_greet_menu(cb: CallbackQuery, bot: Bot):
-    tenant_id = _tenant_id_from_bot(bot)
+    tenant_id = _tenant_id()
     kind = "hello" if cb.data.endswith(":hello") else "bye"
     g = await get_greeting(tenant_id, kind)
     title = "👋 Приветствие" if kind == "hello" else "🧹 Прощание"
@@ -245,10 +332,12 @@ async def cb_child_greet_menu(cb: CallbackQuery, bot: Bot):
 
 @router.chat_join_request()
 async def on_chat_join_request(event: ChatJoinRequest, bot: Bot):
-    tenant_id = _tenant_id_from_bot(bot)
+    tenant_id = _tenant_id()
     chat_id = int(event.chat.id)
     user_id = int(event.from_user.id)
 
+    stats.incr(tenant_id, "joins")
+    broadcast.remember_user(tenant_id, user_id)
     collect = await get_collect_requests(tenant_id)
 
     if collect:
@@ -262,6 +351,7 @@ async def on_chat_join_request(event: ChatJoinRequest, bot: Bot):
         await bot.approve_chat_join_request(chat_id=chat_id, user_id=user_id)
     except Exception:
         return
+    stats.incr(tenant_id, "approvals")
 
     await _send_dm_greeting(bot, user_id, tenant_id, kind="hello")
 
@@ -279,7 +369,8 @@ async def on_chat_member_update(event: ChatMemberUpdated, bot: Bot):
             return
 
         if str(old_status) in {"member"} and str(new_status) in {"left", "kicked"}:
-            tenant_id = _tenant_id_from_bot(bot)
+            tenant_id = _tenant_id()
+            stats.incr(tenant_id, "leaves")
 
             user_id = None
             if getattr(event, "from_user", None):
@@ -1,4 +1,4 @@
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 
@@ -11,31 +11,66 @@ def ga_main_kb() -> InlineKeyboardMarkup:
             InlineKeyboardButton(text="🔁 Рестарт", callback_data="ga:restart"),
         ],
         [InlineKeyboardButton(text="👥 Список клиентов", callback_data="ga:clients:1")],
+        [InlineKeyboardButton(text="📊 Статистика", callback_data="ga:stats:7")],
+        [InlineKeyboardButton(text="🔗 Переустановить вебхуки", callback_data="ga:webhooks")],
     ])
 
 
-def ga_clients_kb(items: List[Dict[str, Any]], page: int, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+def ga_webhooks_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔗 Только изменившиеся", callback_data="ga:webhooks:sync")],
+        [InlineKeyboardButton(text="🔐 Всем (новый сертификат)", callback_data="ga:webhooks:force")],
+        [InlineKeyboardButton(text="↩︎ В меню", callback_data="ga:menu")],
+    ])
+
+
+def stats_range_kb(prefix: str, days: int, back: str) -> InlineKeyboardMarkup:
+    ranges = [
+        InlineKeyboardButton(
+            text=f"{'• ' if d == days else ''}{d} дн.",
+            callback_data=f"{prefix}:{d}",
+        )
+        for d in (7, 30, 90)
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[
+        ranges,
+        [InlineKeyboardButton(text="↩︎ В меню", callback_data=back)],
+    ])
+
+
+def ga_clients_kb(
+    items: List[Dict[str, Any]],
+    back: str,
+    page: int = 1,
+    pages: int = 1,
+    prev_cb: Optional[str] = None,
+    next_cb: Optional[str] = None,
+) -> InlineKeyboardMarkup:
+    """
+    back — курсор текущей страницы ("1" или "стр:n|p:id"), по нему карточка
+    клиента возвращает на ту же страницу.
+    """
     rows: list[list[InlineKeyboardButton]] = []
     for r in items:
         owner_label = f"@{r.get('owner_username') or r['owner_user_id']}"
-        rows.append([InlineKeyboardButton(text=owner_label, callback_data=f"ga:tenant:{r['id']}:open:{page}")])
+        rows.append([InlineKeyboardButton(text=owner_label, callback_data=f"ga:tenant:{r['id']}:open:{back}")])
 
     nav: list[InlineKeyboardButton] = []
-    if has_prev:
-        nav.append(InlineKeyboardButton(text="⟵", callback_data=f"ga:clients:{page-1}"))
-    nav.append(InlineKeyboardButton(text=f"Стр. {page}", callback_data="noop"))
-    if has_next:
-        nav.append(InlineKeyboardButton(text="⟶", callback_data=f"ga:clients:{page+1}"))
+    if prev_cb:
+        nav.append(InlineKeyboardButton(text="⟵", callback_data=prev_cb))
+    nav.append(InlineKeyboardButton(text=f"Стр. {page}/{pages}", callback_data="noop"))
+    if next_cb:
+        nav.append(InlineKeyboardButton(text="⟶", callback_data=next_cb))
     rows.append(nav)
 
     rows.append([InlineKeyboardButton(text="↩︎ В меню", callback_data="ga:menu")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-def tenant_card_kb(tenant_id: int, page_back: int) -> InlineKeyboardMarkup:
+def tenant_card_kb(tenant_id: int, back: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🗑 Удалить клиента", callback_data=f"ga:tenant:{tenant_id}:delete:{page_back}")],
-        [InlineKeyboardButton(text="↩︎ К списку", callback_data=f"ga:clients:{page_back}")],
+        [InlineKeyboardButton(text="🗑 Удалить клиента", callback_data=f"ga:tenant:{tenant_id}:delete:{back}")],
+        [InlineKeyboardButton(text="↩︎ К списку", callback_data=f"ga:clients:{back}")],
     ])
 
 
@@ -56,6 +91,17 @@ def child_admin_kb() -> InlineKeyboardMarkup:
     ])
 
 
+def broadcast_kb(running: bool) -> InlineKeyboardMarkup:
+    rows: list[list[InlineKeyboardButton]] = []
+    if running:
+        rows.append([InlineKeyboardButton(text="🔄 Обновить", callback_data="child:broadcast")])
+        rows.append([InlineKeyboardButton(text="⏹ Остановить", callback_data="child:broadcast:cancel")])
+    else:
+        rows.append([InlineKeyboardButton(text="✉️ Новая рассылка", callback_data="child:broadcast:new")])
+    rows.append([InlineKeyboardButton(text="↩︎ В меню", callback_data="child:home")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
 def channels_list_kb(items: List[Dict[str, Any]], page: int = 1) -> InlineKeyboardMarkup:
     rows: list[list[InlineKeyboardButton]] = []
     if items:
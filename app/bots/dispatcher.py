@@ -1,5 +1,5 @@
 from aiogram import Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
+from app.bots.fsm_storage import make_storage
 
 def make_dp() -> Dispatcher:
-    return Dispatcher(storage=MemoryStorage())
+    return Dispatcher(storage=make_storage())
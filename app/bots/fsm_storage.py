@@ -0,0 +1,357 @@
+# app/bots/fsm_storage.py
+"""
+FSM-хранилище вместо MemoryStorage: компактные записи, вытеснение по простою (TTL)
+и по размеру (LRU), пустые ключи вообще не хранятся.
+
+Опционально (FSM_SNAPSHOT) — периодический снимок в Postgres: многошаговые
+редакторы переживают рестарт и видны другим воркерам. Локальная память остаётся
+кэшем поверх таблицы (read-through для ключей, которые есть в снимке).
+
+Между процессами uvicorn состояния расходятся через шину инвалидации
+(CACHE_BUS_ENABLED): после снимка процесс рассылает записанные и удалённые ключи,
+остальные выкидывают свои чистые копии и дочитывают строку из БД. Задержка — до
+FSM_SNAPSHOT_INTERVAL. Без шины общий FSM работает только в режиме CHILD_WORKERS,
+где тенант закреплён за одним процессом.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from app.db import pg
+from app.services import invalidation
+from app.settings import settings
+
+log = logging.getLogger(__name__)
+
+# DDL применяется один раз на старте: app.services.schema.ensure_schema
+CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS fsm_state (
+  key TEXT PRIMARY KEY,
+  state TEXT,
+  data JSONB NOT NULL DEFAULT '{}'::jsonb,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state(updated_at);
+"""
+
+_UPSERT_SQL = """
+INSERT INTO fsm_state (key, state, data, updated_at)
+SELECT u.key, u.state, u.data::jsonb, NOW()
+FROM unnest($1::text[], $2::text[], $3::text[]) AS u(key, state, data)
+ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = NOW()
+"""
+
+_Key = Tuple[Any, ...]
+
+
+class _Record:
+    __slots__ = ("state", "data", "touched", "dirty")
+
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None):
+        self.state = state
+        self.data = data or None      # пустой dict не держим
+        self.touched = time.monotonic()
+        self.dirty = False
+
+
+def _compact(key: StorageKey) -> _Key:
+    return (key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny)
+
+
+def _db_key(k: _Key) -> str:
+    return ":".join("" if part is None else str(part) for part in k)
+
+
+def _from_db_key(s: str) -> _Key:
+    bot_id, chat_id, user_id, thread_id, business_id, destiny = s.split(":", 5)
+    return (
+        int(bot_id), int(chat_id), int(user_id),
+        int(thread_id) if thread_id else None, business_id or None, destiny,
+    )
+
+
+class CompactStorage(BaseStorage):
+    def __init__(self, ttl: float, max_keys: int, snapshot: bool = False):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.snapshot_enabled = snapshot
+        self._records: "OrderedDict[_Key, _Record]" = OrderedDict()
+        # для снимка: что дописать/удалить в БД и какие ключи там уже есть
+        self._evicted_dirty: Dict[_Key, _Record] = {}
+        self._deleted: Set[str] = set()
+        self._remote_keys: Set[str] = set()
+        self._lock = asyncio.Lock()
+
+    # ----- локальная часть -----
+
+    def _expired(self, rec: _Record, now: float) -> bool:
+        return now - rec.touched > self.ttl
+
+    def _sweep(self, now: float) -> None:
+        while self._records:
+            k, rec = next(iter(self._records.items()))
+            if len(self._records) <= self.max_keys and not self._expired(rec, now):
+                break
+            self._records.popitem(last=False)
+            if rec.dirty and not self._expired(rec, now):
+                # вытеснили по размеру, но в БД ещё не записано — допишем снимком
+                self._evicted_dirty[k] = rec
+
+    async def _get(self, key: StorageKey) -> Optional[_Record]:
+        k = _compact(key)
+        now = time.monotonic()
+        rec = self._records.get(k)
+        if rec is not None and self._expired(rec, now):
+            del self._records[k]
+            rec = None
+        if rec is None:
+            rec = self._evicted_dirty.pop(k, None)
+            if rec is None and self.snapshot_enabled:
+                db_key = _db_key(k)
+                # удалённый локально ключ ещё лежит в БД до снимка — не воскрешаем его
+                if db_key in self._remote_keys and db_key not in self._deleted:
+                    rec = await self._load_one(k)
+            if rec is None:
+                return None
+            self._records[k] = rec
+        rec.touched = now
+        self._records.move_to_end(k)
+        return rec
+
+    async def _put(self, key: StorageKey, state: Optional[str], data: Optional[Dict[str, Any]]) -> None:
+        k = _compact(key)
+        now = time.monotonic()
+        if state is None and not data:
+            # пустая запись == отсутствие записи
+            self._records.pop(k, None)
+            self._evicted_dirty.pop(k, None)
+            if self.snapshot_enabled:
+                self._deleted.add(_db_key(k))
+                self._remote_keys.discard(_db_key(k))
+            return
+        rec = self._records.get(k)
+        if rec is None:
+            rec = self._records[k] = _Record()
+        rec.state, rec.data = state, (dict(data) if data else None)
+        rec.touched, rec.dirty = now, self.snapshot_enabled
+        self._records.move_to_end(k)
+        if self.snapshot_enabled:
+            self._deleted.discard(_db_key(k))
+        self._sweep(now)
+
+    # ----- BaseStorage -----
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        rec = await self._get(key)
+        await self._put(key, value, rec.data if rec else None)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        rec = await self._get(key)
+        return rec.state if rec else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        rec = await self._get(key)
+        await self._put(key, rec.state if rec else None, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        rec = await self._get(key)
+        return dict(rec.data) if rec and rec.data else {}
+
+    async def close(self) -> None:
+        await self.snapshot()
+
+    def stats(self) -> Dict[str, int]:
+        return {"keys": len(self._records), "max": self.max_keys}
+
+    # ----- изменения из других процессов -----
+
+    def apply_remote(self, changed: List[str], removed: List[str]) -> None:
+        """Другой процесс записал снимок: локальные чистые копии этих ключей устарели."""
+        self._remote_keys.update(changed)
+        self._remote_keys.difference_update(removed)
+        for db_key in (*changed, *removed):
+            try:
+                k = _from_db_key(db_key)
+            except ValueError:
+                continue
+            rec = self._records.get(k)
+            # несохранённые локальные правки не трогаем — их запишет наш снимок
+            if rec is not None and not rec.dirty:
+                del self._records[k]
+
+    def drop_clean(self) -> None:
+        """Уведомления могли потеряться — все чистые копии перечитаем из БД."""
+        for k in [k for k, rec in self._records.items() if not rec.dirty]:
+            del self._records[k]
+
+    # ----- снимок в Postgres -----
+
+    async def _load_one(self, k: _Key) -> Optional[_Record]:
+        async with pg() as conn:
+            row = await conn.fetchrow(
+                "SELECT state, data FROM fsm_state WHERE key=$1 "
+                "AND updated_at > NOW() - make_interval(secs => $2)",
+                _db_key(k), self.ttl,
+            )
+        if not row:
+            self._remote_keys.discard(_db_key(k))
+            return None
+        data = row["data"]
+        return _Record(row["state"], json.loads(data) if isinstance(data, str) else data)
+
+    async def load_keys(self) -> None:
+        """Какие ключи есть в снимке — чтобы не ходить в БД за заведомо пустыми."""
+        if not self.snapshot_enabled:
+            return
+        async with pg() as conn:
+            rows = await conn.fetch(
+                "SELECT key FROM fsm_state WHERE updated_at > NOW() - make_interval(secs => $1)",
+                self.ttl,
+            )
+        self._remote_keys = {r["key"] for r in rows}
+
+    async def snapshot(self) -> None:
+        if not self.snapshot_enabled:
+            return
+        async with self._lock:
+            dirty: List[Tuple[_Key, _Record]] = [(k, r) for k, r in self._records.items() if r.dirty]
+            dirty.extend(self._evicted_dirty.items())
+            self._evicted_dirty = {}
+            deleted, self._deleted = self._deleted, set()
+
+            keys: List[str] = []
+            states: List[Optional[str]] = []
+            datas: List[str] = []
+            for k, rec in dirty:
+                try:
+                    datas.append(json.dumps(rec.data or {}, ensure_ascii=False))
+                except (TypeError, ValueError):
+                    # не-JSON данные остаются только в памяти
+                    rec.dirty = False
+                    continue
+                keys.append(_db_key(k))
+                states.append(rec.state)
+                rec.dirty = False
+
+            try:
+                async with pg() as conn:
+                    async with conn.transaction():
+                        if keys:
+                            await conn.execute(_UPSERT_SQL, keys, states, datas)
+                        if deleted:
+                            await conn.execute("DELETE FROM fsm_state WHERE key = ANY($1::text[])", list(deleted))
+                        await conn.execute(
+                            "DELETE FROM fsm_state WHERE updated_at < NOW() - make_interval(secs => $1)",
+                            self.ttl,
+                        )
+                        if settings.CACHE_BUS_ENABLED and (keys or deleted):
+                            await invalidation.publish_keys(conn, "fsm", keys, list(deleted))
+            except Exception:
+                for k, rec in dirty:
+                    rec.dirty = True
+                    if k not in self._records:
+                        self._evicted_dirty[k] = rec
+                self._deleted |= deleted
+                raise
+            # полный набор ключей читаем только на старте (и при переезде тенантов);
+            # дальше ведём его по своим записям и уведомлениям шины от других
+            # процессов. Истёкшие по TTL ключи отсеет _load_one при первом промахе.
+            self._remote_keys.update(keys)
+            self._remote_keys -= deleted
+
+
+# все хранилища процесса — для общего цикла снимков и закрытия на shutdown
+_storages: List[CompactStorage] = []
+
+
+def make_storage() -> CompactStorage:
+    storage = CompactStorage(settings.FSM_TTL, settings.FSM_MAX_KEYS, snapshot=settings.FSM_SNAPSHOT)
+    _storages.append(storage)
+    return storage
+
+
+def _on_remote_keys(changed: List[str], removed: List[str]) -> None:
+    for s in _storages:
+        if s.snapshot_enabled:
+            s.apply_remote(changed, removed)
+
+
+def _on_bus_reset() -> None:
+    for s in _storages:
+        if s.snapshot_enabled:
+            s.drop_clean()
+    snapshots.request_reload()
+
+
+invalidation.subscribe_keys("fsm", _on_remote_keys, _on_bus_reset)
+
+
+class SnapshotLoop:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._reload = False
+
+    async def start(self) -> None:
+        if not settings.FSM_SNAPSHOT or self._task is not None:
+            return
+        for s in _storages:
+            await s.load_keys()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(settings.FSM_SNAPSHOT_INTERVAL)
+            if self._reload:
+                self._reload = False
+                try:
+                    await self.reload_keys()
+                except Exception:
+                    self._reload = True
+                    log.exception("fsm keys reload failed")
+            for s in _storages:
+                try:
+                    await s.snapshot()
+                except Exception:
+                    log.exception("fsm snapshot failed")
+
+    def request_reload(self) -> None:
+        """Перечитать набор ключей на следующем шаге цикла (после переподключения шины)."""
+        self._reload = True
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for s in _storages:
+            try:
+                await s.close()
+            except Exception:
+                log.exception("fsm snapshot on shutdown failed")
+
+    async def flush(self) -> None:
+        """Внеочередной снимок (тенанты переезжают в другой процесс-воркер)."""
+        for s in _storages:
+            await s.snapshot()
+
+    async def reload_keys(self) -> None:
+        """Перечитать набор ключей снимка — к нам переехали чужие тенанты."""
+        for s in _storages:
+            await s.load_keys()
+
+    def stats(self) -> List[Dict[str, int]]:
+        return [s.stats() for s in _storages]
+
+
+snapshots = SnapshotLoop()
@@ -1,20 +1,35 @@
 from aiogram import Router, F, Bot
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, CallbackQuery
-
-from app.settings import ADMIN_IDS
-from app.bots.common import ga_main_kb, ga_clients_kb, tenant_card_kb
+from typing import Optional
+
+from app.settings import ADMIN_IDS, settings
+from app.bots.common import ga_main_kb, ga_clients_kb, tenant_card_kb, stats_range_kb, ga_webhooks_kb
+from app.services import stats, broadcast
+from app.bots.registry import child_bots
+from app.bots.workers import child_workers
+from app.bots.polling import poller
 from app.services.membership import is_in_group
 from app.services.tenants_simple import (
     get_tenant_by_owner, upsert_tenant, save_bot_username,
-    list_tenants, get_tenant, delete_tenant,
+    list_tenants_page, count_tenants, search_tenants, get_tenant, delete_tenant,
 )
-from app.services.webhooks_child import set_child_webhook
+from app.services.webhooks import set_ga_webhook
+from app.services.webhooks_child import set_child_webhook, resync_webhooks, resync_running
 
 import asyncio
 
 router = Router()
 
+# долгие фоновые операции из меню GA; держим ссылки, чтобы задачи не собрал GC
+_bg_tasks: "set[asyncio.Task]" = set()
+
+def _spawn_bg(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+    return task
+
 # =======================
 #  Онбординг /start
 # =======================
@@ -50,10 +65,13 @@ async def connect_child(msg: Message, bot: Bot):
     token = msg.text.strip()
     tenant_id, secret = await upsert_tenant(uid, msg.from_user.username, token)
 
-    cbot = Bot(token)
+    cbot = child_bots.get(tenant_id, token)
     me = await cbot.get_me()
     await save_bot_username(tenant_id, me.username)
-    await set_child_webhook(cbot, tenant_id, secret)
+    if settings.USE_WEBHOOK:
+        await set_child_webhook(cbot, tenant_id, secret)
+    else:
+        poller.add(tenant_id)
 
     await msg.answer(f"Ваш бот успешно подключён! Перейдите к нему и завершите настройку: @{me.username}")
 
@@ -108,31 +126,83 @@ async def ga_restart(cb: CallbackQuery):
 
 
 # Список клиентов на кнопках
-@router.callback_query(F.data.startswith("ga:clients:"))
+#
+# Курсор страницы в callback_data: "1" — первая страница, "стр:n:id" — записи с id < id,
+# "стр:p:id" — записи с id > id (шаг назад). Так любая страница — один индексный запрос.
+
+CLIENTS_PAGE_SIZE = 10
+_CURSOR_RE = r"\d+(?::[np]:\d+)?"
+
+
+async def _render_clients(cb: CallbackQuery, cursor: str, header: str = "Список клиентов:"):
+    parts = cursor.split(":")
+    page = int(parts[0])
+    after_id: Optional[int] = None
+    before_id: Optional[int] = None
+    if len(parts) == 3:
+        if parts[1] == "n":
+            after_id = int(parts[2])
+        else:
+            before_id = int(parts[2])
+
+    rows, more = await list_tenants_page(after_id, before_id, CLIENTS_PAGE_SIZE)
+    if before_id is not None and not more:
+        # дошли до самого верха — это первая страница, что бы ни говорил счётчик в курсоре
+        page = 1
+    if not rows and page > 1:
+        # страница опустела (например, удалили последнего) — на первую
+        page = 1
+        before_id = after_id = None
+        rows, more = await list_tenants_page(None, None, CLIENTS_PAGE_SIZE)
+
+    has_next = more if before_id is None else True
+    has_prev = page > 1
+    total = await count_tenants()
+    pages = max(1, -(-total // CLIENTS_PAGE_SIZE))
+
+    kb = ga_clients_kb(
+        rows,
+        back=cursor,
+        page=page,
+        pages=max(pages, page),
+        prev_cb=f"ga:clients:{page - 1}:p:{rows[0]['id']}" if has_prev and rows else None,
+        next_cb=f"ga:clients:{page + 1}:n:{rows[-1]['id']}" if has_next and rows else None,
+    )
+    await cb.message.edit_text(f"{header}\nВсего: {total}")
+    await cb.message.edit_reply_markup(reply_markup=kb)
+
+
+@router.callback_query(F.data.regexp(rf"^ga:clients:{_CURSOR_RE}$"))
 async def ga_clients(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS:
         return await cb.answer()
-    page = int(cb.data.split(":")[-1])
-    page_size = 10
-    rows = await list_tenants(page, page_size)
-    has_next = len(rows) > page_size
-    rows = rows[:page_size]
-
-    text = "Список клиентов:"
-    kb = ga_clients_kb(rows, page, page > 1, has_next)
-    await cb.message.edit_text(text)
-    await cb.message.edit_reply_markup(reply_markup=kb)
+    await _render_clients(cb, cb.data.split(":", 2)[2])
     await cb.answer()
 
 
+# Поиск клиента: /find @username | часть username | id
+@router.message(Command("find"))
+async def ga_find(msg: Message, command: CommandObject):
+    if msg.from_user.id not in ADMIN_IDS:
+        return
+    if not command.args:
+        return await msg.answer("Использование: /find @username (владелец или бот) или id")
+    rows = await search_tenants(command.args)
+    if not rows:
+        return await msg.answer("Ничего не найдено.")
+    await msg.answer(
+        f"Найдено: {len(rows)}",
+        reply_markup=ga_clients_kb(rows, back="1"),
+    )
+
+
 # Открыть карточку клиента из списка
-@router.callback_query(F.data.regexp(r"^ga:tenant:\d+:open:\d+$"))
+@router.callback_query(F.data.regexp(rf"^ga:tenant:\d+:open:{_CURSOR_RE}$"))
 async def ga_open_tenant(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS:
         return await cb.answer()
-    _, _, tid, _, page_back = cb.data.split(":")
+    _, _, tid, _, back = cb.data.split(":", 4)
     tenant_id = int(tid)
-    page_back = int(page_back)
 
     t = await get_tenant(tenant_id)
     if not t:
@@ -146,29 +216,135 @@ async def ga_open_tenant(cb: CallbackQuery):
         f"Статус: {'Активен' if t.get('is_active') else 'Выключен'}\n"
     )
     await cb.message.edit_text(text)
-    await cb.message.edit_reply_markup(reply_markup=tenant_card_kb(t['id'], page_back))
+    await cb.message.edit_reply_markup(reply_markup=tenant_card_kb(t['id'], back))
     await cb.answer()
 
 
 # Удалить клиента и вернуться к списку на той же странице
-@router.callback_query(F.data.regexp(r"^ga:tenant:\d+:delete:\d+$"))
+@router.callback_query(F.data.regexp(rf"^ga:tenant:\d+:delete:{_CURSOR_RE}$"))
 async def ga_delete_tenant(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS:
         return await cb.answer()
-    _, _, tid, _, page_back = cb.data.split(":")
+    _, _, tid, _, back = cb.data.split(":", 4)
     tid = int(tid)
-    page = int(page_back)
 
+    # рассылка держит свой Bot и иначе продолжит слать аудитории удалённого тенанта
+    await broadcast.cancel_broadcast(tid)
     await delete_tenant(tid)
+    child_bots.drop(tid)
+    poller.remove(tid)
 
     # Перерисуем список
-    page_size = 10
-    rows = await list_tenants(page, page_size)
-    has_next = len(rows) > page_size
-    rows = rows[:page_size]
+    await _render_clients(cb, back, header="Клиент удалён.\n\nСписок клиентов:")
+    await cb.answer()
 
-    text = "Клиент удалён.\n\nСписок клиентов:"
-    kb = ga_clients_kb(rows, page, page > 1, has_next)
-    await cb.message.edit_text(text)
-    await cb.message.edit_reply_markup(reply_markup=kb)
+
+# Статистика по всем тенантам + топ по заявкам
+@router.callback_query(F.data.regexp(r"^ga:stats:\d+$"))
+async def ga_stats(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        return await cb.answer()
+    days = min(int(cb.data.split(":")[-1]), 366)
+
+    t = await stats.range_totals(None, days)
+    top = await stats.top_tenants(days, limit=10)
+
+    lines = [
+        f"📊 Все клиенты за {days} дн.",
+        "",
+        f"Заявок: {t['joins']}",
+        f"Одобрено: {t['approvals']}",
+        f"Вышло: {t['leaves']}",
+        f"ЛС доставлено: {t['dm_ok']} / не доставлено: {t['dm_failed']}",
+        "",
+        "Топ по заявкам:",
+    ]
+    for i, r in enumerate(top, 1):
+        owner = r.get("owner_username") or r["owner_user_id"]
+        lines.append(f"{i}. @{r.get('bot_username') or '—'} (@{owner}) — {r['joins']}")
+    if not top:
+        lines.append("—")
+
+    await cb.message.edit_text("\n".join(lines), reply_markup=stats_range_kb("ga:stats", days, "ga:menu"))
+    await cb.answer()
+
+
+# Переустановка вебхуков всем клиентам (после смены WEB_BASE или сертификата)
+@router.callback_query(F.data == "ga:webhooks")
+async def ga_webhooks(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        return await cb.answer()
+    if not settings.USE_WEBHOOK:
+        return await cb.answer("Сервис работает в режиме polling — вебхуки не нужны.", show_alert=True)
+    await cb.message.edit_text(
+        "Переустановка вебхуков.\n\n"
+        "Только изменившиеся — сверяем с Telegram (смена адреса).\n"
+        "Всем — без сверки, после замены сертификата.",
+        reply_markup=ga_webhooks_kb(),
+    )
+    await cb.answer()
+
+
+@router.callback_query(F.data.in_({"ga:webhooks:sync", "ga:webhooks:force"}))
+async def ga_webhooks_run(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        return await cb.answer()
+    if not settings.USE_WEBHOOK:
+        return await cb.answer("Сервис работает в режиме polling — вебхуки не нужны.", show_alert=True)
+    if resync_running():
+        return await cb.answer("Уже идёт, дождись отчёта.", show_alert=True)
+    force = cb.data.endswith(":force")
+    await cb.message.answer("Переустанавливаю вебхуки всем…" if force else "Переустанавливаю вебхуки…")
     await cb.answer()
+
+    # может идти минутами — не держим обработку апдейта
+    async def run():
+        try:
+            r = await resync_webhooks(force=force)
+            if force:
+                # сертификат общий — GA тоже переставляем
+                await set_ga_webhook(cb.bot, force=True)
+        except Exception as e:
+            return await cb.message.answer(f"Ошибка: {e}")
+        await cb.message.answer(
+            f"Готово. Всего: {r['total']}, обновлено: {r['updated']}, "
+            f"уже актуальны: {r['skipped']}, ошибок: {r['failed']}"
+        )
+
+    _spawn_bg(run())
+
+
+# Процессы-воркеры детских ботов: /workers — нагрузка, /workers N — изменить число
+@router.message(Command("workers"))
+async def ga_workers(msg: Message, command: CommandObject):
+    if msg.from_user.id not in ADMIN_IDS:
+        return
+    if command.args:
+        arg = command.args.strip()
+        if not arg.isdigit() or int(arg) > settings.CHILD_WORKERS_MAX:
+            return await msg.answer(f"Использование: /workers [число воркеров, 0–{settings.CHILD_WORKERS_MAX}]")
+        if child_workers.resizing:
+            return await msg.answer("Ребалансировка уже идёт, дождись отчёта.")
+
+        # дренаж и вывод воркеров занимают секунды — не держим обработку апдейта
+        async def run(count: int):
+            try:
+                await child_workers.resize(count)
+            except Exception as e:
+                return await msg.answer(f"Ошибка: {e}")
+            await msg.answer(f"Готово, воркеров: {len(child_workers.stats())}.")
+
+        _spawn_bg(run(int(arg)))
+        return await msg.answer(f"Меняю число воркеров на {arg}…")
+
+    rows = child_workers.stats()
+    if not rows:
+        return await msg.answer("Многопроцессный режим выключен (все тенанты в одном процессе).")
+    lines = [f"Воркеров: {len(rows)}", ""]
+    for i, w in enumerate(rows):
+        state = "ok" if w["alive"] else "упал"
+        lines.append(
+            f"#{i} pid {w['pid']} [{state}] — тенантов {w['tenants']}, очередь {w['depth']}, "
+            f"обработано {w['processed']}, отказов {w['rejected']}"
+        )
+    await msg.answer("\n".join(lines))
@@ -0,0 +1,146 @@
+# app/bots/ingest.py
+"""
+Быстрый приём апдейтов: вебхук кладёт апдейт в ограниченную очередь тенанта
+и сразу отвечает Telegram 200, а обработку делают воркеры.
+
+У тенанта несколько «дорожек» (lanes), апдейты раскладываются по ним по chat_id:
+апдейты одного чата всегда идут в одну дорожку и обрабатываются по порядку,
+разные чаты — параллельно. Воркер дорожки завершается после простоя,
+так что тысячи тихих тенантов не держат тысячи задач.
+"""
+import asyncio
+import json
+import logging
+from typing import Any, Dict, FrozenSet, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+try:  # orjson заметно быстрее на типичных апдейтах; без него — стандартный json
+    from orjson import loads as _json_loads
+except ImportError:  # pragma: no cover
+    _json_loads = json.loads
+
+log = logging.getLogger(__name__)
+
+
+class UpdateDecoder:
+    """
+    Быстрый разбор тела вебхука: сырые байты -> быстрый JSON -> проверка типа апдейта
+    по хендлерам, которые реально есть в диспетчере. Ненужные типы отбрасываются
+    до дорогой pydantic-валидации Update.
+    """
+    def __init__(self, dp: Dispatcher):
+        self.dp = dp
+        self._types: Optional[FrozenSet[str]] = None
+        self.dropped = 0
+
+    @property
+    def used_types(self) -> FrozenSet[str]:
+        # роутеры подключаются при импорте — считаем лениво, при первом апдейте
+        if self._types is None:
+            self._types = frozenset(self.dp.resolve_used_update_types())
+        return self._types
+
+    def decode(self, raw: bytes) -> Optional[Update]:
+        """None — апдейт никому не нужен, можно сразу отвечать 200."""
+        data = _json_loads(raw)
+        used = self.used_types
+        if not any(key in used for key in data):
+            self.dropped += 1
+            return None
+        return Update.model_validate(data)
+
+
+def chat_key(update: Update) -> int:
+    """chat_id апдейта (или id пользователя, если чата нет) — ключ упорядочивания."""
+    try:
+        event = update.event
+    except Exception:
+        return 0
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return int(chat.id)
+    user = getattr(event, "from_user", None)
+    return int(user.id) if user is not None else 0
+
+
+class _Lane:
+    __slots__ = ("queue", "worker")
+
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.worker: Optional[asyncio.Task] = None
+
+
+class UpdateIngestor:
+    def __init__(self, dp: Dispatcher, lanes: int, maxsize: int, idle_timeout: float):
+        self.dp = dp
+        self.lanes = max(1, lanes)
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._lanes: Dict[tuple[int, int], _Lane] = {}
+        self._rejected = 0
+        self._processed = 0
+
+    def submit(self, key: int, bot: Bot, update: Update, **kwargs: Any) -> bool:
+        """
+        Ставит апдейт в очередь тенанта key. False — очередь полна
+        (вебхук отвечает 503, Telegram повторит доставку позже).
+        """
+        lane_key = (key, chat_key(update) % self.lanes)
+        lane = self._lanes.get(lane_key)
+        if lane is None:
+            lane = self._lanes[lane_key] = _Lane(self.maxsize)
+        try:
+            lane.queue.put_nowait((bot, update, kwargs))
+        except asyncio.QueueFull:
+            self._rejected += 1
+            return False
+        if lane.worker is None or lane.worker.done():
+            lane.worker = asyncio.create_task(self._work(lane_key, lane))
+        return True
+
+    async def _work(self, lane_key: tuple[int, int], lane: _Lane) -> None:
+        while True:
+            try:
+                bot, update, kwargs = await asyncio.wait_for(lane.queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                if lane.queue.empty():
+                    self._lanes.pop(lane_key, None)
+                    return
+                continue
+            try:
+                await self.dp.feed_update(bot, update, **kwargs)
+            except Exception:
+                log.exception("update %s (lane %s) failed", update.update_id, lane_key)
+            finally:
+                self._processed += 1
+                lane.queue.task_done()
+
+    def stats(self) -> Dict[str, int]:
+        depths = [lane.queue.qsize() for lane in self._lanes.values()]
+        return {
+            "tenants": len({key for key, _ in self._lanes}),
+            "lanes": len(depths),
+            "depth": sum(depths),
+            "max_lane_depth": max(depths, default=0),
+            "processed": self._processed,
+            "rejected": self._rejected,
+        }
+
+    async def drain(self) -> None:
+        """Ждёт, пока будет обработано всё, что уже стоит в очередях."""
+        await asyncio.gather(*(lane.queue.join() for lane in list(self._lanes.values())))
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Даём воркерам дообработать очереди, остальное отменяем."""
+        lanes = list(self._lanes.values())
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            log.warning("ingest: %s updates dropped on shutdown", sum(lane.queue.qsize() for lane in lanes))
+        for lane in lanes:
+            if lane.worker is not None:
+                lane.worker.cancel()
+        self._lanes.clear()
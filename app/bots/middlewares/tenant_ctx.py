@@ -1,10 +1,16 @@
 # app/bots/middlewares/tenant_ctx.py
+from contextvars import ContextVar
 from aiogram import BaseMiddleware
-from typing import Callable, Any, Awaitable, Dict
+from typing import Callable, Any, Awaitable, Dict, Optional
+
+# Тенант текущего апдейта. У каждого апдейта своя копия контекста,
+# поэтому параллельные апдейты одного и того же бота не видят друг друга.
+current_tenant: ContextVar[Optional[Dict[str, Any]]] = ContextVar("current_tenant", default=None)
 
 class TenantContext(BaseMiddleware):
     """
-    Кладём в data["tenant"] объект, который заранее положили в bot._tenant.
+    Вебхук передаёт тенанта в dp.feed_update(..., tenant={...}) — он уже лежит в data["tenant"].
+    Здесь выставляем его в contextvar на время обработки апдейта.
     Работает для message/callback_query/chat_join_request/chat_member и т.д.
     """
     async def __call__(
@@ -13,7 +19,11 @@ class TenantContext(BaseMiddleware):
         event: Any,
         data: Dict[str, Any]
     ) -> Any:
-        tenant = getattr(getattr(event, "bot", None), "_tenant", None)
-        if tenant:
-            data["tenant"] = tenant
-        return await handler(event, data)
+        tenant = data.get("tenant")
+        if not tenant:
+            return await handler(event, data)
+        token = current_tenant.set(tenant)
+        try:
+            return await handler(event, data)
+        finally:
+            current_tenant.reset(token)
@@ -0,0 +1,346 @@
+# app/bots/polling.py
+"""
+Long polling детских ботов для USE_WEBHOOK=False: один цикл событий опрашивает
+getUpdates тысяч токенов.
+
+- одновременно висит не больше POLL_CONCURRENCY запросов (они делят общий
+  HTTP-пул реестра ботов, поэтому лимит ниже TG_HTTP_LIMIT);
+- «горячие» тенанты (апдейты за последние POLL_HOT_WINDOW сек) держат длинный
+  опрос, пока есть свободные слоты; остальные опрашиваются коротко и всё реже —
+  пауза удваивается от POLL_IDLE_MIN до POLL_IDLE_MAX;
+- offset каждого тенанта пачкой сохраняется в poll_offsets, после рестарта
+  опрос продолжается с него;
+- апдейты идут в тот же детский диспетчер через очереди ingest (порядок по чату).
+
+GA-бот в этом режиме опрашивается отдельно (BotPoller) — обычный длинный опрос
+одного токена. Токен может опрашивать только один процесс: при нескольких
+воркерах uvicorn лишние получают 409 и ждут POLL_IDLE_MAX.
+"""
+import asyncio
+import heapq
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramConflictError,
+    TelegramRetryAfter,
+    TelegramUnauthorizedError,
+)
+
+from app.bots.ingest import UpdateDecoder, UpdateIngestor
+from app.bots.registry import child_bots
+from app.routers.child_webhook import decoder, ingest
+from app.db import pg
+from app.services.tenants_simple import get_tenant_auth
+from app.settings import settings
+
+log = logging.getLogger(__name__)
+
+# DDL применяется один раз на старте: app.services.schema.ensure_schema
+CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS poll_offsets (
+  tenant_id INTEGER PRIMARY KEY,
+  next_offset BIGINT NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+"""
+
+_FLUSH_SQL = """
+INSERT INTO poll_offsets (tenant_id, next_offset, updated_at)
+SELECT u.tenant_id, u.next_offset, NOW()
+FROM unnest($1::int[], $2::bigint[]) AS u(tenant_id, next_offset)
+ON CONFLICT (tenant_id) DO UPDATE SET next_offset = EXCLUDED.next_offset, updated_at = NOW()
+"""
+
+
+class _Tenant:
+    __slots__ = ("id", "gen", "offset", "last_update", "idle_delay", "webhook_cleared")
+
+    def __init__(self, tenant_id: int, gen: int, offset: Optional[int]):
+        self.id = tenant_id
+        self.gen = gen                 # записи в heap от прежнего add() игнорируются
+        self.offset = offset
+        self.last_update = 0.0
+        self.idle_delay = settings.POLL_IDLE_MIN
+        self.webhook_cleared = False
+
+
+class PollingEngine:
+    def __init__(self, concurrency: int):
+        self.concurrency = max(1, concurrency)
+        self._tenants: Dict[int, _Tenant] = {}
+        self._due: List[Tuple[float, int, int]] = []   # heap (когда, tenant_id, gen)
+        self._gen = 0
+        self._inflight: set = set()   # tenant_id с getUpdates в полёте — второй опрос токена даст 409
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._active = 0
+        self._dirty: Dict[int, int] = {}
+        self._revoked: set = set()   # отозванные токены не подхватываем при обновлении списка
+        self._tasks: List[asyncio.Task] = []
+        self._polls: set = set()
+        self._updates = 0
+        self._errors = 0
+
+    # ----- состав тенантов -----
+
+    def add(self, tenant_id: int, offset: Optional[int] = None) -> None:
+        self._revoked.discard(tenant_id)
+        if tenant_id in self._tenants:
+            return
+        self._gen += 1
+        t = self._tenants[tenant_id] = _Tenant(tenant_id, self._gen, offset)
+        self._schedule(t, 0.0)
+
+    def remove(self, tenant_id: int) -> None:
+        self._tenants.pop(tenant_id, None)
+
+    async def _load_tenants(self) -> None:
+        """Все активные тенанты с сохранёнными offset — постранично по id."""
+        last_id = 0
+        while True:
+            async with pg() as conn:
+                rows = await conn.fetch(
+                    "SELECT t.id, o.next_offset FROM tenants t "
+                    "LEFT JOIN poll_offsets o ON o.tenant_id = t.id "
+                    "WHERE t.is_active AND t.id > $1 ORDER BY t.id LIMIT 1000",
+                    last_id,
+                )
+            for r in rows:
+                if int(r["id"]) not in self._revoked:
+                    self.add(int(r["id"]), r["next_offset"])
+            if len(rows) < 1000:
+                return
+            last_id = int(rows[-1]["id"])
+
+    # ----- планировщик -----
+
+    def _schedule(self, t: _Tenant, delay: float) -> None:
+        heapq.heappush(self._due, (time.monotonic() + delay, t.id, t.gen))
+        self._wakeup.set()
+
+    async def _scheduler(self) -> None:
+        while True:
+            now = time.monotonic()
+            if not self._due or self._due[0][0] > now:
+                timeout = self._due[0][0] - now if self._due else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, tenant_id, gen = heapq.heappop(self._due)
+            t = self._tenants.get(tenant_id)
+            if t is None or t.gen != gen:
+                continue
+            if tenant_id in self._inflight:
+                # тенанта удалили и добавили заново, пока висел прежний опрос
+                self._schedule(t, 1.0)
+                continue
+            await self._slots.acquire()
+            self._inflight.add(tenant_id)
+            task = asyncio.create_task(self._poll(t))
+            self._polls.add(task)
+            task.add_done_callback(self._polls.discard)
+
+    def _timeout_for(self, t: _Tenant) -> int:
+        hot = time.monotonic() - t.last_update < settings.POLL_HOT_WINDOW
+        # длинный опрос держит слот: отдаём его только горячим и пока слотов с запасом
+        if hot and self._active < self.concurrency // 2:
+            return settings.POLL_TIMEOUT
+        return 0
+
+    async def _poll(self, t: _Tenant) -> None:
+        self._active += 1
+        delay = 0.0
+        try:
+            auth = await get_tenant_auth(t.id)
+            if not auth or not auth.is_active:
+                self.remove(t.id)
+                return
+            bot = child_bots.get(auth.id, auth.bot_token)
+            if not t.webhook_cleared:
+                await bot.delete_webhook(drop_pending_updates=False)
+                t.webhook_cleared = True
+
+            timeout = self._timeout_for(t)
+            updates = await bot.get_updates(
+                offset=t.offset,
+                timeout=timeout,
+                allowed_updates=sorted(decoder.used_types),
+                request_timeout=timeout + 15,
+            )
+            if updates:
+                t.last_update = time.monotonic()
+                t.idle_delay = settings.POLL_IDLE_MIN
+                tenant = {"id": auth.id, "owner_user_id": auth.owner_user_id}
+                for update in updates:
+                    # очередь чата полна — ждём места, а не обрабатываем в обход очереди
+                    while not ingest.submit(auth.id, bot, update, tenant=tenant):
+                        await asyncio.sleep(0.05)
+                t.offset = updates[-1].update_id + 1
+                self._dirty[t.id] = t.offset
+                self._updates += len(updates)
+            elif timeout == 0:
+                delay = t.idle_delay
+                t.idle_delay = min(t.idle_delay * 2, settings.POLL_IDLE_MAX)
+        except TelegramUnauthorizedError:
+            log.warning("polling: tenant %s token revoked, stop polling", t.id)
+            self.remove(t.id)
+            self._revoked.add(t.id)
+        except TelegramConflictError:
+            # вебхук снова выставлен или токен опрашивает кто-то ещё
+            t.webhook_cleared = False
+            delay = settings.POLL_IDLE_MAX
+        except TelegramRetryAfter as e:
+            delay = float(e.retry_after)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._errors += 1
+            log.exception("polling: tenant %s failed", t.id)
+            delay = t.idle_delay
+            t.idle_delay = min(t.idle_delay * 2, settings.POLL_IDLE_MAX)
+        finally:
+            self._active -= 1
+            self._slots.release()
+            self._inflight.discard(t.id)
+            # тенант мог быть удалён и добавлен заново — тогда его уже запланировал add()
+            if self._tenants.get(t.id) is t:
+                self._schedule(t, delay)
+
+    # ----- offset'ы -----
+
+    async def flush_offsets(self) -> None:
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            async with pg() as conn:
+                await conn.execute(_FLUSH_SQL, list(batch.keys()), list(batch.values()))
+        except Exception:
+            for tid, off in batch.items():
+                self._dirty.setdefault(tid, off)
+            raise
+
+    async def _flusher(self) -> None:
+        while True:
+            await asyncio.sleep(settings.POLL_OFFSET_FLUSH)
+            try:
+                await self.flush_offsets()
+            except Exception:
+                log.exception("poll offsets flush failed")
+
+    async def _refresher(self) -> None:
+        # новые тенанты подхватываются и без явного add()
+        while True:
+            await asyncio.sleep(settings.POLL_REFRESH)
+            try:
+                await self._load_tenants()
+            except Exception:
+                log.exception("polling: tenants refresh failed")
+
+    # ----- жизненный цикл -----
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        await self._load_tenants()
+        self._tasks = [
+            asyncio.create_task(self._scheduler()),
+            asyncio.create_task(self._flusher()),
+            asyncio.create_task(self._refresher()),
+        ]
+
+    async def stop(self) -> None:
+        tasks = self._tasks + list(self._polls)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        try:
+            await self.flush_offsets()
+        except Exception:
+            log.exception("poll offsets flush on shutdown failed")
+
+    def stats(self) -> Dict[str, int]:
+        hot_since = time.monotonic() - settings.POLL_HOT_WINDOW
+        return {
+            "tenants": len(self._tenants),
+            "hot": sum(1 for t in self._tenants.values() if t.last_update > hot_since),
+            "active_polls": self._active,
+            "updates": self._updates,
+            "errors": self._errors,
+        }
+
+
+poller = PollingEngine(settings.POLL_CONCURRENCY)
+
+
+class BotPoller:
+    """Long polling одного бота (GA) в свой диспетчер через его очередь ingest."""
+
+    def __init__(self, bot: Bot, ingest_: UpdateIngestor, decoder_: UpdateDecoder, key: int = 0):
+        self.bot = bot
+        self.ingest = ingest_
+        self.decoder = decoder_
+        self.key = key
+        self._task: Optional[asyncio.Task] = None
+        self._updates = 0
+        self._errors = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        # offset не сохраняем: неподтверждённое Telegram отдаст снова после рестарта
+        offset: Optional[int] = None
+        webhook_cleared = False
+        backoff = settings.POLL_IDLE_MIN
+        while True:
+            try:
+                if not webhook_cleared:
+                    await self.bot.delete_webhook(drop_pending_updates=False)
+                    webhook_cleared = True
+                updates = await self.bot.get_updates(
+                    offset=offset,
+                    timeout=settings.POLL_TIMEOUT,
+                    allowed_updates=sorted(self.decoder.used_types),
+                    request_timeout=settings.POLL_TIMEOUT + 15,
+                )
+                for update in updates:
+                    while not self.ingest.submit(self.key, self.bot, update):
+                        await asyncio.sleep(0.05)
+                if updates:
+                    offset = updates[-1].update_id + 1
+                    self._updates += len(updates)
+                backoff = settings.POLL_IDLE_MIN
+            except asyncio.CancelledError:
+                raise
+            except TelegramConflictError:
+                # вебхук снова выставлен или токен опрашивает другой процесс
+                webhook_cleared = False
+                await asyncio.sleep(settings.POLL_IDLE_MAX)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception:
+                self._errors += 1
+                log.exception("polling: bot %s failed", self.bot.id)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, settings.POLL_IDLE_MAX)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, int]:
+        return {"running": int(self._task is not None), "updates": self._updates, "errors": self._errors}
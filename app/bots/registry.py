@@ -0,0 +1,76 @@
+# app/bots/registry.py
+"""
+Реестр детских Bot-объектов: LRU + вытеснение по простою.
+Все детские боты ходят в api.telegram.org через ОДНУ aiohttp-сессию
+с общим пулом соединений — тысячи тенантов не держат тысячи пулов.
+"""
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+
+from app.settings import settings
+
+
+def make_shared_session() -> AiohttpSession:
+    session = AiohttpSession(limit=settings.TG_HTTP_LIMIT)
+    # keep-alive и лимит на хост — параметры TCPConnector
+    session._connector_init.update(
+        limit_per_host=settings.TG_HTTP_LIMIT_PER_HOST,
+        keepalive_timeout=settings.TG_HTTP_KEEPALIVE,
+    )
+    return session
+
+
+class BotRegistry:
+    def __init__(self, max_size: int, idle_ttl: float):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        # tenant_id -> (bot, last_used); порядок — от давно использованных к свежим
+        self._bots: "OrderedDict[int, tuple[Bot, float]]" = OrderedDict()
+        self._session: Optional[AiohttpSession] = None
+
+    @property
+    def session(self) -> AiohttpSession:
+        if self._session is None:
+            self._session = make_shared_session()
+        return self._session
+
+    def get(self, tenant_id: int, token: str) -> Bot:
+        now = time.monotonic()
+        item = self._bots.get(tenant_id)
+        if item is not None and item[0].token == token:
+            bot = item[0]
+        else:
+            bot = Bot(token, session=self.session)
+        self._bots[tenant_id] = (bot, now)
+        self._bots.move_to_end(tenant_id)
+        self._evict(now)
+        return bot
+
+    def drop(self, tenant_id: int) -> None:
+        self._bots.pop(tenant_id, None)
+
+    def _evict(self, now: float) -> None:
+        # сессия общая, поэтому вытесненному боту закрывать нечего — просто отпускаем ссылку
+        while len(self._bots) > self.max_size:
+            self._bots.popitem(last=False)
+        while self._bots:
+            _, (_, last_used) = next(iter(self._bots.items()))
+            if now - last_used <= self.idle_ttl:
+                break
+            self._bots.popitem(last=False)
+
+    async def close(self) -> None:
+        self._bots.clear()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def stats(self) -> Dict[str, int]:
+        return {"bots": len(self._bots), "max": self.max_size}
+
+
+child_bots = BotRegistry(settings.CHILD_BOTS_MAX, settings.CHILD_BOTS_IDLE_TTL)
@@ -0,0 +1,369 @@
+# app/bots/workers.py
+"""
+Многопроцессный режим для детских ботов (CHILD_WORKERS > 0).
+
+HTTP-фронт не разбирает апдейт: из пути берётся только tenant_id, и сырое тело
+уходит в один из N процессов-воркеров, выбранный консистентным хешированием
+по tenant_id. Каждый тенант всегда попадает в один и тот же воркер, поэтому там
+остаются тёплыми кэш авторизации, сессия Bot и FSM-состояния его пользователей.
+
+При изменении числа воркеров (resize) на другой процесс переезжает лишь ~1/N
+тенантов. Пока прежние владельцы не дообработали всё, что было поставлено им до
+переключения, апдейты переехавших тенантов получают 503 (Telegram повторит) —
+так порядок по чату не ломается и тенант не обрабатывается в двух процессах
+сразу. FSM-состояния переезжают через снимок в Postgres, т.е. только при FSM_SNAPSHOT.
+
+Упавший воркер фронт замечает сразу: его тенанты получают 503, а не копятся
+в очереди, которую никто не читает. Супервизор поднимает процесс заново на том же
+месте кольца и перекладывает в него недочитанную очередь.
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing as mp
+import queue as queue_mod
+import time
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+from app.settings import settings
+
+log = logging.getLogger(__name__)
+
+_ctx = mp.get_context("spawn")
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Кольцо с виртуальными узлами: узел -> vnodes точек на окружности."""
+
+    def __init__(self, nodes: Sequence[int], vnodes: int = 160):
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self._keys = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
+
+    def node_for(self, key: int) -> int:
+        i = bisect.bisect(self._keys, _hash(str(key))) % len(self._keys)
+        return self._nodes[i]
+
+
+# ===== процесс-воркер =====
+
+async def _serve(index: int, count: int, vnodes: int, q, counters) -> None:
+    # импорты здесь: воркер стартует через spawn и поднимает своё окружение сам
+    from fastapi import HTTPException
+    from app.db import init_pool, close_pool
+    from app.routers.child_webhook import prepare_update, ingest
+    from app.services.pending import flush_all_writers
+    from app.services.invalidation import listener as cache_bus
+    from app.services.stats import flusher as stats_flusher
+    from app.services import broadcast
+    from app.bots.registry import child_bots
+    from app.bots.fsm_storage import snapshots as fsm_snapshots
+    from app.services.prewarm import prewarm
+
+    processed, forbidden, failed, barrier = counters
+    loop = asyncio.get_running_loop()
+
+    await init_pool()
+    if settings.CACHE_BUS_ENABLED:
+        cache_bus.start()
+    stats_flusher.start()
+    broadcast.audience_flusher.start()
+    await fsm_snapshots.start()
+    if settings.PREWARM_ENABLED:
+        # греем только тенантов, которые по кольцу достаются этому воркеру
+        ring = HashRing(range(count), vnodes)
+        await prewarm(lambda tenant_id: ring.node_for(tenant_id) == index)
+    log.info("child worker %s started", index)
+
+    try:
+        while True:
+            item = await loop.run_in_executor(None, q.get)
+            if item is None:
+                break
+            if item[0] == _BARRIER:
+                # всё, что стояло до метки, обработано — тенантов можно отдавать
+                await ingest.drain()
+                try:
+                    await fsm_snapshots.flush()
+                except Exception:
+                    log.exception("worker %s: fsm snapshot before rebalance failed", index)
+                barrier.value = item[1]
+                continue
+            if item[0] == _RELOAD_FSM:
+                try:
+                    await fsm_snapshots.reload_keys()
+                except Exception:
+                    log.exception("worker %s: fsm keys reload failed", index)
+                continue
+            tenant_id, secret, raw = item
+            try:
+                prepared = await prepare_update(tenant_id, secret, raw)
+            except HTTPException:
+                forbidden.value += 1
+                continue
+            except Exception:
+                failed.value += 1
+                log.exception("worker %s: tenant %s update failed", index, tenant_id)
+                continue
+            if prepared is not None:
+                key, bot, update, tenant = prepared
+                # очередь тенанта полна — не читаем дальше, пока не освободится:
+                # копится mp-очередь, и фронт начинает отвечать 503
+                while not ingest.submit(key, bot, update, tenant=tenant):
+                    await asyncio.sleep(0.05)
+            processed.value += 1
+    finally:
+        await ingest.close()
+        await flush_all_writers()
+        await stats_flusher.stop()
+        await broadcast.stop_all()
+        await broadcast.audience_flusher.stop()
+        await fsm_snapshots.stop()
+        await cache_bus.stop()
+        await child_bots.close()
+        await close_pool()
+        log.info("child worker %s stopped", index)
+
+
+# служебные сообщения в очереди воркера (апдейты — кортежи (tenant_id, secret, raw))
+_BARRIER = "barrier"
+_RELOAD_FSM = "reload_fsm"
+
+
+def _worker_main(index: int, count: int, vnodes: int, q, counters) -> None:
+    asyncio.run(_serve(index, count, vnodes, q, counters))
+
+
+# ===== фронт: пул воркеров =====
+
+class _Worker:
+    __slots__ = ("index", "queue", "process", "counters", "submitted", "rejected", "tenants")
+
+    def __init__(self, index: int, count: int, vnodes: int, maxsize: int):
+        self.index = index
+        self.queue = _ctx.Queue(maxsize)
+        # processed, forbidden, failed, номер последнего пройденного барьера
+        self.counters = tuple(_ctx.Value("q", 0, lock=False) for _ in range(4))
+        self.process = _ctx.Process(
+            target=_worker_main, args=(index, count, vnodes, self.queue, self.counters),
+            name=f"child-worker-{index}", daemon=True,
+        )
+        self.submitted = 0
+        self.rejected = 0
+        self.tenants: Set[int] = set()
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            depth = self.queue.qsize()
+        except NotImplementedError:  # macOS
+            depth = -1
+        processed, forbidden, failed, _ = (c.value for c in self.counters)
+        return {
+            "pid": self.process.pid,
+            "alive": self.process.is_alive(),
+            "tenants": len(self.tenants),
+            "depth": depth,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "processed": processed,
+            "forbidden": forbidden,
+            "failed": failed,
+        }
+
+
+class WorkerPool:
+    def __init__(self, maxsize: int, vnodes: int):
+        self.maxsize = maxsize
+        self.vnodes = vnodes
+        self._workers: List[_Worker] = []
+        self._ring: Optional[HashRing] = None
+        # пока идёт ребалансировка: кольцо до неё — кто из тенантов переехал
+        self._old_ring: Optional[HashRing] = None
+        self._barrier_seq = 0
+        self._paused = 0
+        self._dead = 0          # отказов из-за упавшего воркера
+        self._restarts = 0
+        self._supervisor: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._ring is not None
+
+    @property
+    def resizing(self) -> bool:
+        return self._lock.locked()
+
+    def submit(self, tenant_id: int, secret: str, raw: bytes) -> bool:
+        """
+        Отдаёт сырой апдейт воркеру тенанта. False — очередь полна, воркер упал
+        и ещё не перезапущен, или тенант переезжает и прежний воркер ещё
+        не дообработал его (503).
+        """
+        node = self._ring.node_for(tenant_id)
+        if self._old_ring is not None and self._old_ring.node_for(tenant_id) != node:
+            self._paused += 1
+            return False
+        w = self._workers[node]
+        if not w.process.is_alive():
+            w.rejected += 1
+            self._dead += 1
+            return False
+        try:
+            w.queue.put_nowait((tenant_id, secret, raw))
+        except queue_mod.Full:
+            w.rejected += 1
+            return False
+        w.submitted += 1
+        w.tenants.add(tenant_id)
+        return True
+
+    async def start(self, count: int) -> None:
+        await self.resize(count)
+
+    async def resize(self, count: int, drain_timeout: float = 60.0) -> None:
+        """
+        Меняет число воркеров:
+        1) новые воркеры стартуют, кольцо перестраивается, но переехавшие тенанты
+           на паузе (503);
+        2) прежним воркерам ставится метка-барьер: дойдя до неё, воркер дообработал
+           всё поставленное раньше и сбросил FSM в снимок;
+        3) пауза снимается, оставшиеся воркеры перечитывают ключи снимка FSM,
+           лишние выводятся.
+        """
+        async with self._lock:
+            count = max(0, count)
+            old = list(self._workers)
+            workers = list(old)
+            for i in range(len(old), count):
+                w = _Worker(i, count, self.vnodes, self.maxsize)
+                w.process.start()
+                workers.append(w)
+            retired = workers[count:]
+
+            if count == 0:
+                # останов: переезжать некуда, воркеры дообработают очередь на выходе
+                await self._stop_supervisor()
+                self._ring = None
+                self._workers = []
+            elif self._ring is not None:
+                self._old_ring = self._ring
+                self._workers = workers
+                self._ring = HashRing(range(count), self.vnodes)
+                try:
+                    await self._barrier(old, drain_timeout)
+                finally:
+                    self._old_ring = None
+                    self._workers = workers[:count]
+                if settings.FSM_SNAPSHOT:
+                    await self._broadcast(self._workers, (_RELOAD_FSM,))
+            else:
+                self._workers = workers
+                self._ring = HashRing(range(count), self.vnodes)
+                self._supervisor = asyncio.create_task(self._supervise())
+
+            for w in self._workers:
+                w.tenants.clear()
+            await asyncio.gather(*(self._retire(w) for w in retired))
+
+    async def _broadcast(self, workers: List[_Worker], item: tuple) -> None:
+        loop = asyncio.get_running_loop()
+        for w in workers:
+            if w.process.is_alive():
+                await loop.run_in_executor(None, w.queue.put, item)
+
+    async def _barrier(self, workers: List[_Worker], timeout: float) -> None:
+        self._barrier_seq += 1
+        seq = self._barrier_seq
+        await self._broadcast(workers, (_BARRIER, seq))
+        deadline = time.monotonic() + timeout
+        while any(w.process.is_alive() and w.counters[3].value < seq for w in workers):
+            if time.monotonic() > deadline:
+                log.warning("child workers rebalance: drain did not finish in %ss", timeout)
+                return
+            await asyncio.sleep(0.1)
+
+    async def _retire(self, w: _Worker, timeout: float = 30.0) -> None:
+        loop = asyncio.get_running_loop()
+        if w.process.is_alive():
+            await loop.run_in_executor(None, w.queue.put, None)
+            await loop.run_in_executor(None, w.process.join, timeout)
+        if w.process.is_alive():
+            log.warning("child worker %s did not stop in %ss, terminating", w.index, timeout)
+            w.process.terminate()
+        w.queue.close()
+
+    # ----- перезапуск упавших воркеров -----
+
+    async def _supervise(self, interval: float = 1.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            # во время resize состав меняется — проверим на следующем круге
+            if self._lock.locked():
+                continue
+            async with self._lock:
+                for i, w in enumerate(self._workers):
+                    if not w.process.is_alive():
+                        try:
+                            self._workers[i] = await self._respawn(w)
+                        except Exception:
+                            log.exception("child worker %s restart failed", w.index)
+
+    async def _respawn(self, dead: _Worker) -> _Worker:
+        log.error(
+            "child worker %s (pid %s) died with exit code %s, restarting",
+            dead.index, dead.process.pid, dead.process.exitcode,
+        )
+        w = _Worker(dead.index, len(self._workers), self.vnodes, self.maxsize)
+        w.process.start()
+        # что упавший не успел забрать из очереди — отдаём новому, порядок тот же
+        moved = lost = 0
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                item = await loop.run_in_executor(None, dead.queue.get, True, 0.1)
+            except (queue_mod.Empty, OSError, EOFError):
+                break
+            try:
+                w.queue.put_nowait(item)
+                moved += 1
+            except queue_mod.Full:
+                lost += 1
+        if moved or lost:
+            log.warning("child worker %s: %s queued updates moved, %s lost", w.index, moved, lost)
+        dead.queue.close()
+        w.tenants = dead.tenants
+        self._restarts += 1
+        return w
+
+    async def _stop_supervisor(self) -> None:
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            try:
+                await self._supervisor
+            except asyncio.CancelledError:
+                pass
+            self._supervisor = None
+
+    async def stop(self) -> None:
+        await self.resize(0)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [w.stats() for w in self._workers]
+
+    def pool_stats(self) -> Dict[str, Any]:
+        return {
+            "rebalancing": self._old_ring is not None,
+            "paused": self._paused,
+            "dead_rejected": self._dead,
+            "restarts": self._restarts,
+            "workers": self.stats(),
+        }
+
+
+child_workers = WorkerPool(settings.CHILD_WORKER_QUEUE, settings.CHILD_WORKER_VNODES)
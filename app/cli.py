@@ -0,0 +1,53 @@
+"""
+Служебные команды без поднятия веб-сервиса:
+
+    python -m app.cli resync-webhooks [--force]
+"""
+import argparse
+import asyncio
+import json
+
+from aiogram import Bot
+
+from app.bots.registry import child_bots
+from app.db import init_pool, close_pool
+from app.services import schema
+from app.services.webhooks import set_ga_webhook
+from app.services.webhooks_child import resync_webhooks
+from app.settings import settings
+
+
+async def _resync_webhooks(args: argparse.Namespace) -> None:
+    await init_pool()
+    try:
+        await schema.ensure_schema()
+        result = await resync_webhooks(force=args.force)
+        if args.force:
+            # сертификат общий — GA тоже переставляем
+            ga = Bot(settings.GA_BOT_TOKEN)
+            try:
+                await set_ga_webhook(ga, force=True)
+            finally:
+                await ga.session.close()
+        print(json.dumps(result))
+    finally:
+        await child_bots.close()
+        await close_pool()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.cli")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("resync-webhooks", help="переустановить вебхуки всем активным тенантам")
+    p.add_argument(
+        "--force", action="store_true",
+        help="не сверять с getWebhookInfo, ставить всем (после замены сертификата)",
+    )
+    p.set_defaults(func=_resync_webhooks)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,8 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import asyncpg
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from app.settings import settings
 
@@ -6,4 +11,75 @@ AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=As
 
 async def get_session() -> AsyncSession:
     async with AsyncSessionLocal() as session:
-        yield session
\ No newline at end of file
+        yield session
+
+
+# ===== общий asyncpg-пул для *_simple сервисов =====
+
+_pool: Optional[asyncpg.Pool] = None
+_pool_lock: Optional[asyncio.Lock] = None
+_waiters = 0
+
+def pg_dsn() -> str:
+    # для asyncpg нужна строка без суффикса +asyncpg
+    return settings.DATABASE_URL.replace("+asyncpg", "")
+
+async def init_pool() -> asyncpg.Pool:
+    """
+    Создаёт пул один раз на процесс (вызывается на старте FastAPI).
+    Если кто-то обратился к БД раньше — пул создастся лениво тут же.
+    """
+    global _pool, _pool_lock
+    if _pool is not None:
+        return _pool
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(
+                dsn=pg_dsn(),
+                min_size=settings.PG_POOL_MIN,
+                max_size=settings.PG_POOL_MAX,
+                max_inactive_connection_lifetime=settings.PG_POOL_MAX_IDLE,
+            )
+    return _pool
+
+async def close_pool() -> None:
+    global _pool
+    if _pool is None:
+        return
+    pool, _pool = _pool, None
+    await pool.close()
+
+@asynccontextmanager
+async def pg() -> AsyncIterator[asyncpg.Connection]:
+    """
+    Берём соединение из общего пула и обязательно возвращаем его обратно.
+    Если за PG_ACQUIRE_TIMEOUT свободного соединения нет — asyncio.TimeoutError.
+    """
+    global _waiters
+    pool = _pool or await init_pool()
+    _waiters += 1
+    try:
+        conn = await pool.acquire(timeout=settings.PG_ACQUIRE_TIMEOUT)
+    finally:
+        _waiters -= 1
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+def pool_stats() -> Dict[str, int]:
+    if _pool is None:
+        return {"size": 0, "in_use": 0, "idle": 0, "waiters": _waiters,
+                "min": settings.PG_POOL_MIN, "max": settings.PG_POOL_MAX}
+    size = _pool.get_size()
+    idle = _pool.get_idle_size()
+    return {
+        "size": size,
+        "in_use": size - idle,
+        "idle": idle,
+        "waiters": _waiters,
+        "min": _pool.get_min_size(),
+        "max": _pool.get_max_size(),
+    }
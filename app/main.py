@@ -1,21 +1,122 @@
-from fastapi import FastAPI
-from app.routers.ga_webhook import router as ga_router
-from app.routers.child_webhook import router as child_router
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict
+
+from fastapi import FastAPI, Response
+from app.routers.ga_webhook import router as ga_router, ingest as ga_ingest, decoder as ga_decoder, bot as ga_bot
+from app.routers.child_webhook import router as child_router, ingest as child_ingest, decoder as child_decoder
 from app.settings import settings
 from app.services.webhooks import set_ga_webhook
-from aiogram import Bot
+from app.db import init_pool, close_pool, pool_stats
+from app.services import schema
+from app.services.pending import flush_all_writers
+from app.services.invalidation import listener as cache_bus
+from app.services.stats import flusher as stats_flusher
+from app.services import broadcast
+from app.services.prewarm import prewarm
+from app.services.tenants_simple import get_tenant_auth
+from app.bots.registry import child_bots
+from app.bots.fsm_storage import snapshots as fsm_snapshots
+from app.bots.workers import child_workers
+from app.bots.polling import poller, BotPoller
+
+# GA без вебхука (USE_WEBHOOK=False) — тоже через long polling
+ga_poller = BotPoller(ga_bot, ga_ingest, ga_decoder)
+
+# как прошёл последний старт: время до готовности и по этапам — в /metrics
+_startup: Dict[str, Any] = {}
+
+
+async def _child_bot_for(tenant_id: int):
+    auth = await get_tenant_auth(tenant_id)
+    if not auth or not auth.is_active:
+        return None
+    return child_bots.get(auth.id, auth.bot_token)
+
+
+async def _startup_steps() -> None:
+    started = time.monotonic()
+    await init_pool()
+    await schema.ensure_schema()
+    _startup["schema_s"] = round(time.monotonic() - started, 3)
+
+    if settings.CACHE_BUS_ENABLED:
+        cache_bus.start()
+    stats_flusher.start()
+    broadcast.audience_flusher.start()
+    await fsm_snapshots.start()
+
+    # в многопроцессном режиме детских тенантов греют воркеры, каждый своих
+    if settings.PREWARM_ENABLED and settings.CHILD_WORKERS <= 0:
+        _startup["prewarm"] = await prewarm()
+
+    await broadcast.resume_broadcasts(_child_bot_for)
+    broadcast.resumer.start(_child_bot_for)
+    if settings.CHILD_WORKERS > 0:
+        await child_workers.start(settings.CHILD_WORKERS)
+    if settings.USE_WEBHOOK:
+        _startup["ga_webhook"] = "set" if await set_ga_webhook(ga_bot) else "unchanged"
+    else:
+        ga_poller.start()
+        await poller.start()
+    _startup["ready_s"] = round(time.monotonic() - started, 3)
 
-app = FastAPI(title="Multi-tenant JoinBot")
+
+async def _shutdown_steps() -> None:
+    await child_workers.stop()
+    await poller.stop()
+    await ga_poller.stop()
+    await ga_ingest.close()
+    await child_ingest.close()
+    await flush_all_writers()
+    await stats_flusher.stop()
+    await broadcast.resumer.stop()
+    await broadcast.stop_all()
+    await broadcast.audience_flusher.stop()
+    await fsm_snapshots.stop()
+    await cache_bus.stop()
+    await child_bots.close()
+    await ga_bot.session.close()
+    await close_pool()
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    await _startup_steps()
+    try:
+        yield
+    finally:
+        await _shutdown_steps()
+
+
+app = FastAPI(title="Multi-tenant JoinBot", lifespan=lifespan)
 
 @app.get("/health")
 async def health():
     return {"ok": True}
 
+@app.get("/ready")
+async def ready():
+    # 503, пока не применена схема — балансировщик не шлёт сюда трафик
+    if not schema.is_ready():
+        return Response(status_code=503)
+    return {"ok": True}
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "startup": _startup,
+        "db_pool": pool_stats(),
+        "child_bots": child_bots.stats(),
+        "cache_bus": cache_bus.stats(),
+        "fsm": fsm_snapshots.stats(),
+        "ingest": {
+            "ga": {**ga_ingest.stats(), "dropped": ga_decoder.dropped},
+            "child": {**child_ingest.stats(), "dropped": child_decoder.dropped},
+        },
+        "child_workers": child_workers.pool_stats(),
+        "polling": {**poller.stats(), "ga": ga_poller.stats()},
+    }
+
 app.include_router(ga_router)
 app.include_router(child_router)
-
-@app.on_event("startup")
-async def on_startup():
-    if settings.USE_WEBHOOK:
-        bot = Bot(settings.GA_BOT_TOKEN)
-        await set_ga_webhook(bot)
@@ -15,6 +15,7 @@ class Tenant(Base):
     secret: Mapped[str] = mapped_column(String(64), index=True)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
     webhook_url: Mapped[str | None] = mapped_column(Text)
+    webhook_error: Mapped[str | None] = mapped_column(Text)
     created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
 
 class Greeting(Base):
@@ -63,6 +64,8 @@ class StatDaily(Base):
     joins: Mapped[int] = mapped_column(Integer, default=0)
     leaves: Mapped[int] = mapped_column(Integer, default=0)
     approvals: Mapped[int] = mapped_column(Integer, default=0)
+    dm_ok: Mapped[int] = mapped_column(Integer, default=0)
+    dm_failed: Mapped[int] = mapped_column(Integer, default=0)
     __table_args__ = (
         UniqueConstraint("tenant_id", "day", name="uq_stats_tenant_day"),
     )
\ No newline at end of file
@@ -1,12 +1,17 @@
 # app/routers/child_webhook.py
-from fastapi import APIRouter, Request, Response, HTTPException
+from typing import Any, Dict, Optional, Tuple
+
 from aiogram import Bot
 from aiogram.types import Update
+from fastapi import APIRouter, Request, Response, HTTPException
 from app.bots.dispatcher import make_dp
 from app.bots import child_bot
-from app.db import AsyncSessionLocal
-from app.models import Tenant
 from app.bots.middlewares.tenant_ctx import TenantContext
+from app.bots.registry import child_bots
+from app.bots.ingest import UpdateIngestor, UpdateDecoder
+from app.bots.workers import child_workers
+from app.services.tenants_simple import get_tenant_auth
+from app.settings import settings
 
 router = APIRouter()
 
@@ -15,33 +20,55 @@ dp.include_router(child_bot.router)
 # важно: вешаем на ВСЕ события (update) — покроет и callback_query
 dp.update.middleware(TenantContext())
 
-_child_bots: dict[int, Bot] = {}
+decoder = UpdateDecoder(dp)
+ingest = UpdateIngestor(
+    dp,
+    lanes=settings.INGEST_WORKERS_PER_TENANT,
+    maxsize=settings.INGEST_QUEUE_SIZE,
+    idle_timeout=settings.INGEST_IDLE_TIMEOUT,
+)
 
-async def _get_bot_for(tenant_id: int) -> Bot:
-    if tenant_id in _child_bots:
-        return _child_bots[tenant_id]
-    async with AsyncSessionLocal() as s:
-        t = await s.get(Tenant, tenant_id)
-    if not t:
-        raise HTTPException(404, "Tenant not found")
-    b = Bot(t.bot_token)
-    _child_bots[tenant_id] = b
-    return b
 
-@router.post("/webhook/child/{tenant_id}/{secret}")
-async def webhook_child(tenant_id: int, secret: str, request: Request):
-    # получаем тенанта
-    async with AsyncSessionLocal() as s:
-        t = await s.get(Tenant, tenant_id)
-    if not t or not t.is_active or t.secret != secret:
+async def prepare_update(
+    tenant_id: int, secret: str, raw: bytes,
+) -> Optional[Tuple[int, Bot, Update, Dict[str, Any]]]:
+    """
+    Проверка секрета и декодирование. None — апдейт не нужен ни одному хендлеру.
+    Общая часть для вебхука и для процессов-воркеров (app.bots.workers).
+    """
+    # тенант из кэша (в БД ходим только на промахе)
+    auth = await get_tenant_auth(tenant_id)
+    if not auth or not auth.is_active or not auth.check_secret(secret):
         raise HTTPException(403, "Forbidden")
 
-    bot = await _get_bot_for(tenant_id)
+    # типы апдейтов без хендлеров отбрасываем до pydantic и до поиска бота
+    update = decoder.decode(raw)
+    if update is None:
+        return None
+
+    bot = child_bots.get(auth.id, auth.bot_token)
+
+    # «легкий» словарь тенанта едет вместе с апдейтом, а не в общем объекте бота
+    tenant = {"id": auth.id, "owner_user_id": auth.owner_user_id}
+    return auth.id, bot, update, tenant
+
+
+@router.post("/webhook/child/{tenant_id}/{secret}")
+async def webhook_child(tenant_id: int, secret: str, request: Request):
+    # многопроцессный режим: секрет проверит воркер тенанта, у него тёплый кэш
+    if child_workers.enabled:
+        if not child_workers.submit(tenant_id, secret, await request.body()):
+            raise HTTPException(503, "Busy")
+        return Response(status_code=200)
 
-    # подложим «легкий» словарь в объект бота – middleware его подцепит
-    bot._tenant = {"id": t.id, "owner_user_id": t.owner_user_id}
+    prepared = await prepare_update(tenant_id, secret, await request.body())
+    if prepared is None:
+        return Response(status_code=200)
+    key, bot, update, tenant = prepared
 
-    data = await request.json()
-    update = Update.model_validate(data)
-    await dp.feed_update(bot, update)
+    if settings.INGEST_MODE == "queue":
+        if not ingest.submit(key, bot, update, tenant=tenant):
+            raise HTTPException(503, "Busy")
+        return Response(status_code=200)
+    await dp.feed_update(bot, update, tenant=tenant)
     return Response(status_code=200)
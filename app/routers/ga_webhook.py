@@ -1,18 +1,31 @@
-from fastapi import APIRouter, Request, Response
+from fastapi import APIRouter, Request, Response, HTTPException
 from aiogram import Bot
-from aiogram.types import Update
 from app.settings import settings
 from app.bots.dispatcher import make_dp
 from app.bots import ga_bot
+from app.bots.ingest import UpdateIngestor, UpdateDecoder
 
 router = APIRouter()
-_bot = Bot(settings.GA_BOT_TOKEN)
+bot = Bot(settings.GA_BOT_TOKEN)
 _dp = make_dp()
 _dp.include_router(ga_bot.router)
 
+decoder = UpdateDecoder(_dp)
+ingest = UpdateIngestor(
+    _dp,
+    lanes=settings.INGEST_WORKERS_PER_TENANT,
+    maxsize=settings.INGEST_QUEUE_SIZE,
+    idle_timeout=settings.INGEST_IDLE_TIMEOUT,
+)
+
 @router.post("/webhook/ga")
 async def webhook_ga(request: Request):
-    data = await request.json()
-    update = Update.model_validate(data)
-    await _dp.feed_update(_bot, update)
+    update = decoder.decode(await request.body())
+    if update is None:
+        return Response(status_code=200)
+    if settings.INGEST_MODE == "queue":
+        if not ingest.submit(0, bot, update):
+            raise HTTPException(503, "Busy")
+        return Response(status_code=200)
+    await _dp.feed_update(bot, update)
     return Response(status_code=200)
@@ -0,0 +1,96 @@
+"""
+Движок «Собрать заявки»: апрувы и ЛС-приветствия идут параллельно,
+но в пределах лимитов Telegram (token bucket на бота + retry_after на 429).
+
+Апрувы и ЛС — две отдельные стадии со своими воркерами и лимитерами:
+медленные ЛС не тормозят апрувы, апрув не ждёт, пока отправится приветствие.
+"""
+import asyncio
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, Iterable, Tuple, Union
+
+from aiogram import Bot
+
+from app.services import stats
+from app.services.pending import StatusWriter
+from app.services.ratelimit import bot_bucket, tg_call
+from app.settings import settings
+
+_DONE = object()
+
+
+async def _aiter(rows: Union[Iterable[Dict[str, Any]], AsyncIterable[Dict[str, Any]]]):
+    if hasattr(rows, "__aiter__"):
+        async for r in rows:
+            yield r
+    else:
+        for r in rows:
+            yield r
+
+
+async def approve_pending(
+    bot: Bot,
+    tenant_id: int,
+    rows: Union[Iterable[Dict[str, Any]], AsyncIterable[Dict[str, Any]]],
+    send_dm: Callable[[int], Awaitable[bool]],
+) -> Tuple[int, int]:
+    """
+    Апрувит заявки из rows (dict с id/chat_id/user_id) и шлёт ЛС через send_dm(user_id).
+    Возвращает (ok, fail).
+    """
+    api = bot_bucket(bot.id, "api", settings.TG_APPROVE_RATE)
+    dm = bot_bucket(bot.id, "dm", settings.TG_DM_RATE)
+
+    approve_q: asyncio.Queue = asyncio.Queue(maxsize=settings.APPROVE_CONCURRENCY * 4)
+    dm_q: asyncio.Queue = asyncio.Queue(maxsize=settings.DM_CONCURRENCY * 4)
+    counters = {"ok": 0, "fail": 0}
+
+    async def approver() -> None:
+        while (r := await approve_q.get()) is not _DONE:
+            chat_id, user_id = int(r["chat_id"]), int(r["user_id"])
+            try:
+                await tg_call(api, lambda: bot.approve_chat_join_request(chat_id=chat_id, user_id=user_id))
+            except Exception as e:
+                await writer.failed(r["id"], error=str(e)[:300])
+                counters["fail"] += 1
+                continue
+            counters["ok"] += 1
+            stats.incr(tenant_id, "approvals")
+            await dm_q.put((r["id"], user_id))
+
+    async def dm_sender() -> None:
+        while (item := await dm_q.get()) is not _DONE:
+            row_id, user_id = item
+            try:
+                delivered = await tg_call(dm, lambda: send_dm(user_id))
+            except Exception:
+                delivered = False
+            await writer.approved(row_id, dm_ok=delivered)
+
+    async def feed() -> None:
+        async for r in _aiter(rows):
+            await approve_q.put(r)
+        for _ in approvers:
+            await approve_q.put(_DONE)
+        await asyncio.gather(*approvers)
+        for _ in senders:
+            await dm_q.put(_DONE)
+        await asyncio.gather(*senders)
+
+    # статусы заявок пишутся пачками; на выходе (в т.ч. по ошибке) буфер дописывается
+    async with StatusWriter() as writer:
+        approvers = [asyncio.create_task(approver()) for _ in range(settings.APPROVE_CONCURRENCY)]
+        senders = [asyncio.create_task(dm_sender()) for _ in range(settings.DM_CONCURRENCY)]
+        tasks = [asyncio.create_task(feed()), *approvers, *senders]
+        try:
+            # упал любой воркер — валим весь прогон, а не ждём put в очередь,
+            # которую больше некому разбирать
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for t in done:
+                if not t.cancelled() and t.exception() is not None:
+                    raise t.exception()
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    return counters["ok"], counters["fail"]
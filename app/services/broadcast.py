@@ -0,0 +1,388 @@
+"""
+Рассылка по аудитории тенанта (все, кто подавал заявку в его чаты).
+
+Получатели читаются страницами по user_id (keyset), после каждой страницы
+в broadcasts пишется курсор и счётчики — после рестарта рассылка продолжается
+с места остановки, а не начинается заново. Кто заблокировал бота — помечается
+в tenant_users.blocked и дальше пропускается.
+
+Рассылку ведёт ровно один процесс: он держит аренду строки (owner, lease_until)
+и продлевает её на каждом чекпоинте. Подхватить рассылку (resume_broadcasts)
+можно только без владельца или с истёкшей арендой — при нескольких воркерах
+uvicorn она не уйдёт аудитории N раз.
+"""
+import asyncio
+import logging
+import secrets
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+
+from app.db import pg
+from app.services.ratelimit import bot_bucket, tg_call
+from app.settings import settings
+
+log = logging.getLogger(__name__)
+
+# DDL применяется один раз на старте: app.services.schema.ensure_schema
+# (после pending_requests — аудитория один раз заполняется из истории заявок)
+CREATE_TABLE_SQL = """
+DO $$
+BEGIN
+  IF to_regclass('tenant_users') IS NULL THEN
+    CREATE TABLE tenant_users (
+      tenant_id INTEGER NOT NULL,
+      user_id BIGINT NOT NULL,
+      first_seen TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+      blocked BOOLEAN NOT NULL DEFAULT FALSE,
+      PRIMARY KEY (tenant_id, user_id)
+    );
+    INSERT INTO tenant_users(tenant_id, user_id)
+    SELECT DISTINCT tenant_id, user_id FROM pending_requests
+    ON CONFLICT DO NOTHING;
+  END IF;
+END $$;
+
+CREATE TABLE IF NOT EXISTS broadcasts (
+  id SERIAL PRIMARY KEY,
+  tenant_id INTEGER NOT NULL,
+  from_chat_id BIGINT NOT NULL,
+  message_id BIGINT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'running',   -- running/done/cancelled/failed
+  cursor_user_id BIGINT NOT NULL DEFAULT 0, -- все user_id <= курсора уже обработаны
+  total INTEGER NOT NULL DEFAULT 0,
+  sent INTEGER NOT NULL DEFAULT 0,
+  failed INTEGER NOT NULL DEFAULT 0,
+  blocked INTEGER NOT NULL DEFAULT 0,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  finished_at TIMESTAMPTZ
+);
+
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS owner TEXT;
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_broadcasts_tenant ON broadcasts(tenant_id, id);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_broadcasts_running ON broadcasts(tenant_id) WHERE status = 'running';
+"""
+
+
+# ===== аудитория: копим в памяти, пишем пачкой =====
+
+_seen: Set[Tuple[int, int]] = set()
+
+def remember_user(tenant_id: int, user_id: int) -> None:
+    _seen.add((tenant_id, user_id))
+
+async def flush_audience() -> None:
+    global _seen
+    if not _seen:
+        return
+    batch, _seen = _seen, set()
+    try:
+        async with pg() as conn:
+            await conn.execute(
+                "INSERT INTO tenant_users(tenant_id, user_id) "
+                "SELECT * FROM unnest($1::int[], $2::bigint[]) "
+                "ON CONFLICT DO NOTHING",
+                [t for t, _ in batch], [u for _, u in batch],
+            )
+    except Exception:
+        _seen |= batch
+        raise
+
+
+class AudienceFlusher:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(settings.STATS_FLUSH_INTERVAL)
+            try:
+                await flush_audience()
+            except Exception:
+                log.exception("audience flush failed")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await flush_audience()
+
+
+audience_flusher = AudienceFlusher()
+
+
+# ===== рассылка =====
+
+# broadcast_id -> задача отправки в этом процессе
+_tasks: Dict[int, asyncio.Task] = {}
+
+# владелец аренды рассылок — этот процесс
+_OWNER = secrets.token_hex(4)
+
+
+async def start_broadcast(bot: Bot, tenant_id: int, from_chat_id: int, message_id: int) -> Optional[int]:
+    """
+    Запускает рассылку копии сообщения (from_chat_id, message_id).
+    None — у тенанта уже идёт рассылка.
+    """
+    await flush_audience()
+    async with pg() as conn:
+        bc_id = await conn.fetchval(
+            """
+            INSERT INTO broadcasts(tenant_id, from_chat_id, message_id, total, owner, lease_until)
+            SELECT $1, $2, $3, COUNT(*), $4, NOW() + make_interval(secs => $5)
+            FROM tenant_users WHERE tenant_id=$1 AND NOT blocked
+            ON CONFLICT (tenant_id) WHERE status = 'running' DO NOTHING
+            RETURNING id
+            """,
+            tenant_id, from_chat_id, message_id, _OWNER, settings.BROADCAST_LEASE,
+        )
+    if bc_id is not None:
+        _spawn(bot, bc_id)
+    return bc_id
+
+
+def _spawn(bot: Bot, bc_id: int) -> None:
+    task = _tasks.get(bc_id)
+    if task is None or task.done():
+        _tasks[bc_id] = asyncio.create_task(_run(bot, bc_id))
+
+
+async def _send_page(bot: Bot, bc: Dict[str, Any], users: List[int]) -> Tuple[int, int, List[int]]:
+    bucket = bot_bucket(bot.id, "dm", settings.TG_DM_RATE)
+    sem = asyncio.Semaphore(settings.BROADCAST_CONCURRENCY)
+    sent, failed, blocked = 0, 0, []
+
+    async def one(user_id: int) -> None:
+        nonlocal sent, failed
+        async with sem:
+            try:
+                await tg_call(bucket, lambda: bot.copy_message(
+                    chat_id=user_id, from_chat_id=bc["from_chat_id"], message_id=bc["message_id"],
+                ))
+                sent += 1
+            except TelegramForbiddenError:
+                blocked.append(user_id)
+            except Exception:
+                failed += 1
+
+    await asyncio.gather(*(one(u) for u in users))
+    return sent, failed, blocked
+
+
+async def _db_step(bc_id: int, fn):
+    """Шаг рассылки с БД: сбой повторяем с растущей паузой, рассылку сразу не бросаем."""
+    delay = 1.0
+    for attempt in range(1, settings.BROADCAST_DB_RETRIES + 1):
+        try:
+            return await fn()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if attempt == settings.BROADCAST_DB_RETRIES:
+                raise
+            log.warning("broadcast %s: db step failed, retry in %.0fs", bc_id, delay, exc_info=True)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+
+async def _run(bot: Bot, bc_id: int) -> None:
+    async def load_page():
+        async with pg() as conn:
+            bc = await conn.fetchrow("SELECT * FROM broadcasts WHERE id=$1", bc_id)
+            # остановлена или аренду (после долгого простоя) перехватил другой процесс
+            if not bc or bc["status"] != "running" or bc["owner"] != _OWNER:
+                return None, []
+            rows = await conn.fetch(
+                "SELECT user_id FROM tenant_users "
+                "WHERE tenant_id=$1 AND NOT blocked AND user_id > $2 "
+                "ORDER BY user_id LIMIT $3",
+                bc["tenant_id"], bc["cursor_user_id"], settings.BROADCAST_PAGE_SIZE,
+            )
+        return bc, [int(r["user_id"]) for r in rows]
+
+    async def finish():
+        async with pg() as conn:
+            await conn.execute(
+                "UPDATE broadcasts SET status='done', finished_at=NOW() "
+                "WHERE id=$1 AND status='running' AND owner=$2",
+                bc_id, _OWNER,
+            )
+
+    try:
+        while True:
+            bc, users = await _db_step(bc_id, load_page)
+            if bc is None:
+                return
+            if not users:
+                await _db_step(bc_id, finish)
+                return
+
+            sent, failed, blocked = await _send_page(bot, bc, users)
+
+            # чекпоинт страницы: курсор, счётчики, блокировки и продление аренды — атомарно
+            async def checkpoint() -> bool:
+                async with pg() as conn:
+                    async with conn.transaction():
+                        res = await conn.execute(
+                            "UPDATE broadcasts SET cursor_user_id=$2, sent=sent+$3, failed=failed+$4, "
+                            "blocked=blocked+$5, lease_until=NOW() + make_interval(secs => $7) "
+                            "WHERE id=$1 AND owner=$6",
+                            bc_id, users[-1], sent, failed, len(blocked), _OWNER, settings.BROADCAST_LEASE,
+                        )
+                        if res == "UPDATE 0":
+                            return False
+                        if blocked:
+                            await conn.execute(
+                                "UPDATE tenant_users SET blocked=TRUE WHERE tenant_id=$1 AND user_id = ANY($2::bigint[])",
+                                bc["tenant_id"], blocked,
+                            )
+                return True
+
+            if not await _db_step(bc_id, checkpoint):
+                log.warning("broadcast %s: lease lost, leaving it to the new owner", bc_id)
+                return
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # повторы не помогли: не оставляем running без задачи, иначе тенант
+        # не сможет начать новую рассылку до рестарта
+        log.exception("broadcast %s failed", bc_id)
+        try:
+            async with pg() as conn:
+                await conn.execute(
+                    "UPDATE broadcasts SET status='failed', finished_at=NOW() "
+                    "WHERE id=$1 AND status='running' AND owner=$2",
+                    bc_id, _OWNER,
+                )
+        except Exception:
+            log.exception("broadcast %s: could not mark as failed", bc_id)
+    finally:
+        _tasks.pop(bc_id, None)
+
+
+async def cancel_broadcast(tenant_id: int) -> bool:
+    async with pg() as conn:
+        bc_id = await conn.fetchval(
+            "UPDATE broadcasts SET status='cancelled', finished_at=NOW() "
+            "WHERE tenant_id=$1 AND status='running' RETURNING id",
+            tenant_id,
+        )
+    task = _tasks.get(bc_id) if bc_id else None
+    if task:
+        task.cancel()
+    return bc_id is not None
+
+
+async def get_progress(tenant_id: int) -> Optional[Dict[str, Any]]:
+    """Последняя рассылка тенанта: статус, sent/failed/blocked и сколько осталось."""
+    async with pg() as conn:
+        bc = await conn.fetchrow(
+            "SELECT * FROM broadcasts WHERE tenant_id=$1 ORDER BY id DESC LIMIT 1",
+            tenant_id,
+        )
+        if not bc:
+            return None
+        remaining = 0
+        if bc["status"] == "running":
+            remaining = await conn.fetchval(
+                "SELECT COUNT(*) FROM tenant_users WHERE tenant_id=$1 AND NOT blocked AND user_id > $2",
+                tenant_id, bc["cursor_user_id"],
+            )
+    out = dict(bc)
+    out["remaining"] = int(remaining)
+    return out
+
+
+async def resume_broadcasts(get_bot) -> int:
+    """
+    Подхватываем незавершённые рассылки без владельца или с истёкшей арендой.
+    Строка забирается одним UPDATE ... RETURNING — из нескольких процессов её
+    получит только один. get_bot(tenant_id) -> Bot | None.
+    """
+    async with pg() as conn:
+        rows = await conn.fetch(
+            "UPDATE broadcasts SET owner=$1, lease_until=NOW() + make_interval(secs => $2) "
+            "WHERE status='running' AND (owner IS NULL OR lease_until IS NULL OR lease_until < NOW()) "
+            "RETURNING id, tenant_id",
+            _OWNER, settings.BROADCAST_LEASE,
+        )
+    resumed = 0
+    for r in rows:
+        bot = await get_bot(int(r["tenant_id"]))
+        if bot is not None:
+            _spawn(bot, int(r["id"]))
+            resumed += 1
+    if resumed < len(rows):
+        # у кого не нашлось бота — отпускаем, подхватит следующий проход
+        await _release([int(r["id"]) for r in rows if int(r["id"]) not in _tasks])
+    return resumed
+
+
+async def _release(ids: Optional[List[int]] = None) -> None:
+    """Снимаем свою аренду (останов процесса) — другие подхватят сразу, без ожидания."""
+    async with pg() as conn:
+        if ids is None:
+            await conn.execute(
+                "UPDATE broadcasts SET owner=NULL, lease_until=NULL WHERE owner=$1 AND status='running'",
+                _OWNER,
+            )
+        else:
+            await conn.execute(
+                "UPDATE broadcasts SET owner=NULL, lease_until=NULL WHERE owner=$1 AND id = ANY($2::int[])",
+                _OWNER, ids,
+            )
+
+
+class BroadcastResumer:
+    """Периодически забирает рассылки, чей владелец умер, не сняв аренду."""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, get_bot) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(get_bot))
+
+    async def _run(self, get_bot) -> None:
+        while True:
+            await asyncio.sleep(settings.BROADCAST_LEASE / 2)
+            try:
+                await resume_broadcasts(get_bot)
+            except Exception:
+                log.exception("broadcast resume failed")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+resumer = BroadcastResumer()
+
+
+async def stop_all() -> None:
+    """Останов сервиса: прогресс уже зачекпоинчен — гасим задачи и отпускаем аренду."""
+    tasks = list(_tasks.values())
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    try:
+        await _release()
+    except Exception:
+        log.exception("broadcast lease release failed")
@@ -1,12 +1,6 @@
 from __future__ import annotations
 from typing import Optional, List, Dict, Any
-import asyncpg
-from app.settings import settings
-
-async def _conn():
-    # для asyncpg нужна строка без суффикса +asyncpg
-    dsn = settings.DATABASE_URL.replace("+asyncpg", "")
-    return await asyncpg.connect(dsn)
+from app.db import pg
 
 async def add_channel_by_id(tenant_id: int, chat_id: int, title: Optional[str]) -> int:
     """
@@ -14,8 +8,7 @@ async def add_channel_by_id(tenant_id: int, chat_id: int, title: Optional[str])
     Уникальность: (tenant_id, chat_id).
     Возвращает id записи.
     """
-    c = await _conn()
-    try:
+    async with pg() as c:
         row = await c.fetchrow(
             """
             INSERT INTO channels (tenant_id, chat_id, title, can_auto_approve)
@@ -28,15 +21,12 @@ async def add_channel_by_id(tenant_id: int, chat_id: int, title: Optional[str])
             tenant_id, chat_id, title
         )
         return int(row["id"])
-    finally:
-        await c.close()
 
 async def list_channels(tenant_id: int) -> List[Dict[str, Any]]:
     """
     Список всех подключённых чатов/каналов для тенанта.
     """
-    c = await _conn()
-    try:
+    async with pg() as c:
         rows = await c.fetch(
             """
             SELECT id, chat_id, title, can_auto_approve
@@ -55,30 +45,22 @@ async def list_channels(tenant_id: int) -> List[Dict[str, Any]]:
                 "can_auto_approve": bool(r["can_auto_approve"]),
             })
         return out
-    finally:
-        await c.close()
 
 async def delete_channel(tenant_id: int, channel_row_id: int) -> None:
     """
     Удаляет запись о канале по её первичному id (а не по chat_id),
     дополнительно фильтруя по tenant_id.
     """
-    c = await _conn()
-    try:
+    async with pg() as c:
         await c.execute(
             "DELETE FROM channels WHERE id=$1 AND tenant_id=$2",
             channel_row_id, tenant_id
         )
-    finally:
-        await c.close()
 
 # Доп. настройка, если понадобится в будущем
 async def set_can_auto_approve(tenant_id: int, channel_row_id: int, enabled: bool) -> None:
-    c = await _conn()
-    try:
+    async with pg() as c:
         await c.execute(
             "UPDATE channels SET can_auto_approve=$1 WHERE id=$2 AND tenant_id=$3",
             enabled, channel_row_id, tenant_id
         )
-    finally:
-        await c.close()
@@ -1,15 +1,16 @@
 from __future__ import annotations
-from typing import Optional, Dict, Any
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, Iterable, List, Tuple
 import asyncpg
 import json
+from aiogram.enums import ParseMode
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from app.db import pg
+from app.services.cache import TTLCache, MISSING
+from app.services.invalidation import subscribe, publish
 from app.settings import settings
 
 
-async def _conn():
-    # asyncpg строка без +asyncpg
-    return await asyncpg.connect(settings.DATABASE_URL.replace("+asyncpg", ""))
-
-
 def _to_dict(maybe_json: Any) -> Dict[str, Any]:
     if maybe_json is None:
         return {}
@@ -48,8 +49,7 @@ def _norm(row: Optional[asyncpg.Record]) -> Optional[Dict[str, Any]]:
 
 
 async def get_greeting(tenant_id: int, kind: str) -> Optional[Dict[str, Any]]:
-    c = await _conn()
-    try:
+    async with pg() as c:
         row = await c.fetchrow(
             """
             SELECT id, tenant_id, kind, text, button_text, button_url,
@@ -59,80 +59,160 @@ async def get_greeting(tenant_id: int, kind: str) -> Optional[Dict[str, Any]]:
             tenant_id, kind,
         )
         return _norm(row)
-    finally:
-        await c.close()
-
-
-async def _upsert_full(
-    tenant_id: int,
-    kind: str,
-    *,
-    text: Optional[str] = None,
-    button_text: Optional[str] = None,
-    button_url: Optional[str] = None,
-    photo_file_id: Optional[str] = None,
-    video_note_file_id: Optional[str] = None,
-    video_file_id: Optional[str] = None,
-    button_kind: Optional[str] = None,  # "start" | "url"
-) -> None:
-    # достаём текущую запись и мерджим значения
-    cur = await get_greeting(tenant_id, kind)
-    text = text if text is not None else (cur or {}).get("text")
-    button_text = button_text if button_text is not None else (cur or {}).get("button_text")
-    button_url = button_url if button_url is not None else (cur or {}).get("button_url")
-    photo_file_id = photo_file_id if photo_file_id is not None else (cur or {}).get("photo_file_id")
-    video_note_file_id = video_note_file_id if video_note_file_id is not None else (cur or {}).get("video_note_file_id")
-    video_file_id = video_file_id if video_file_id is not None else (cur or {}).get("video_file_id")
-    button_kind = button_kind if button_kind is not None else (cur or {}).get("button_kind", "start")
-
-    extra = {"video_file_id": video_file_id, "button_kind": button_kind}
-    extra_json = json.dumps(extra, ensure_ascii=False)
-
-    c = await _conn()
-    try:
-        await c.execute(
+
+
+# ===== скомпилированный «план отправки» для ЛС =====
+
+@dataclass(frozen=True, slots=True)
+class SendPlan:
+    method: str                      # "photo" | "video" | "video_note" | "text"
+    media_id: Optional[str]
+    text: Optional[str]              # подпись к медиа / текст сообщения
+    parse_mode: str
+    reply_markup: Optional[InlineKeyboardMarkup]
+    disable_preview: bool = False
+
+# (tenant_id, kind) -> SendPlan | None (None — отправлять нечего)
+_plans = TTLCache(settings.GREETING_CACHE_TTL, settings.GREETING_CACHE_MAX)
+
+def _compile(g: Optional[Dict[str, Any]]) -> Optional[SendPlan]:
+    if not g:
+        return None
+    text = g.get("text") or None
+    kb: Optional[InlineKeyboardMarkup] = None
+    if g.get("button_text") and g.get("button_url"):
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=g["button_text"], url=g["button_url"])]
+        ])
+    # Медиа приоритет: фото > видео > кружок > просто текст
+    for method, key in (("photo", "photo_file_id"), ("video", "video_file_id"), ("video_note", "video_note_file_id")):
+        if g.get(key):
+            return SendPlan(method, g[key], text, ParseMode.MARKDOWN, kb)
+    if text:
+        return SendPlan("text", None, text, ParseMode.MARKDOWN, kb)
+    return None
+
+async def get_send_plan(tenant_id: int, kind: str) -> Optional[SendPlan]:
+    """
+    То же, что get_greeting, но уже готовое к отправке и из кэша.
+    Сбрасывается сеттерами ниже, поэтому в установившемся режиме БД не трогаем.
+    """
+    key = (tenant_id, kind)
+    plan = _plans.get(key)
+    if plan is MISSING:
+        plan = _compile(await get_greeting(tenant_id, kind))
+        _plans.set(key, plan)
+    return plan
+
+def invalidate_greeting(tenant_id: int, kind: Optional[str] = None) -> None:
+    for k in ((kind,) if kind else ("hello", "bye")):
+        _plans.pop((tenant_id, k))
+
+subscribe("greeting", invalidate_greeting, _plans.clear)
+
+async def prewarm_send_plans(tenant_ids: List[int]) -> int:
+    """Приветствия/прощания пачки тенантов одним запросом; у кого нет — кэшируем None."""
+    if not tenant_ids:
+        return 0
+    async with pg() as c:
+        rows = await c.fetch(
             """
-            INSERT INTO greetings
-                (tenant_id, kind, text, button_text, button_url,
-                 photo_file_id, video_note_file_id, extra)
-            VALUES ($1,$2,$3,$4,$5,$6,$7,$8::jsonb)
-            ON CONFLICT (tenant_id, kind) DO UPDATE SET
-              text=EXCLUDED.text,
-              button_text=EXCLUDED.button_text,
-              button_url=EXCLUDED.button_url,
-              photo_file_id=EXCLUDED.photo_file_id,
-              video_note_file_id=EXCLUDED.video_note_file_id,
-              extra=EXCLUDED.extra
+            SELECT id, tenant_id, kind, text, button_text, button_url,
+                   photo_file_id, video_note_file_id, extra
+            FROM greetings WHERE tenant_id = ANY($1::int[])
             """,
-            tenant_id, kind, text, button_text, button_url,
-            photo_file_id, video_note_file_id, extra_json,
+            tenant_ids,
         )
-    finally:
-        await c.close()
+    found = {(int(r["tenant_id"]), r["kind"]): r for r in rows}
+    for tid in tenant_ids:
+        for kind in ("hello", "bye"):
+            row = found.get((tid, kind))
+            _plans.set((tid, kind), _compile(_norm(row)) if row else None)
+    return len(rows)
+
+
+# ===== частичные апдейты одним запросом =====
+
+# обычные колонки и ключи внутри extra (jsonb)
+_COLUMNS = ("text", "button_text", "button_url", "photo_file_id", "video_note_file_id")
+_EXTRA_KEYS = ("video_file_id", "button_kind")   # button_kind: "start" | "url"
+
+
+def _partial_upsert(tenant_id: int, kind: str, fields: Dict[str, Any]) -> tuple[str, list]:
+    """
+    Собирает ОДИН INSERT ... ON CONFLICT DO UPDATE, который трогает только
+    переданные колонки и только переданные ключи extra (None — значит очистить).
+    Остальные значения остаются как есть — без чтения и мерджа в Python.
+    """
+    unknown = set(fields) - set(_COLUMNS) - set(_EXTRA_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown greeting fields: {', '.join(sorted(unknown))}")
+
+    cols = [k for k in _COLUMNS if k in fields]
+    extra = {k: fields[k] for k in _EXTRA_KEYS if k in fields}
+
+    args: list = [tenant_id, kind, json.dumps(extra, ensure_ascii=False)]
+    args.extend(fields[k] for k in cols)
+    placeholders = ", ".join(f"${i}" for i in range(4, 4 + len(cols)))
+
+    sets = [f"{k}=EXCLUDED.{k}" for k in cols]
+    if extra:
+        sets.append("extra=COALESCE(greetings.extra::jsonb, '{}'::jsonb) || EXCLUDED.extra::jsonb")
+    on_conflict = f"DO UPDATE SET {', '.join(sets)}" if sets else "DO NOTHING"
+
+    sql = (
+        f"INSERT INTO greetings (tenant_id, kind, extra{''.join(', ' + k for k in cols)}) "
+        f"VALUES ($1, $2, $3::jsonb{', ' + placeholders if cols else ''}) "
+        f"ON CONFLICT (tenant_id, kind) {on_conflict}"
+    )
+    return sql, args
+
+
+async def update_greeting(tenant_id: int, kind: str, **fields: Any) -> None:
+    sql, args = _partial_upsert(tenant_id, kind, fields)
+    async with pg() as c:
+        await c.execute(sql, *args)
+        await publish(c, "greeting", tenant_id)
+    invalidate_greeting(tenant_id, kind)
+
+
+async def apply_greeting_edits(tenant_id: int, edits: Iterable[Tuple[str, Dict[str, Any]]]) -> None:
+    """
+    Пачка правок [(kind, {поле: значение}), ...] в одной транзакции:
+    например, сменить медиа и кнопку разом — либо всё, либо ничего.
+    """
+    statements = [(kind, *_partial_upsert(tenant_id, kind, fields)) for kind, fields in edits]
+    async with pg() as c:
+        async with c.transaction():
+            for _, sql, args in statements:
+                await c.execute(sql, *args)
+            await publish(c, "greeting", tenant_id)
+    for kind in {kind for kind, _, _ in statements}:
+        invalidate_greeting(tenant_id, kind)
 
 
 # ===== setters / helpers =====
 
 async def set_text(tenant_id: int, kind: str, text: str) -> None:
-    await _upsert_full(tenant_id, kind, text=text)
+    await update_greeting(tenant_id, kind, text=text)
 
 async def set_photo(tenant_id: int, kind: str, file_id: Optional[str]) -> None:
-    await _upsert_full(tenant_id, kind, photo_file_id=file_id, video_file_id=None, video_note_file_id=None)
+    await update_greeting(tenant_id, kind, photo_file_id=file_id, video_file_id=None, video_note_file_id=None)
 
 async def set_video(tenant_id: int, kind: str, file_id: Optional[str]) -> None:
-    await _upsert_full(tenant_id, kind, video_file_id=file_id, photo_file_id=None, video_note_file_id=None)
+    await update_greeting(tenant_id, kind, video_file_id=file_id, photo_file_id=None, video_note_file_id=None)
 
 async def set_video_note(tenant_id: int, kind: str, file_id: Optional[str]) -> None:
-    await _upsert_full(tenant_id, kind, video_note_file_id=file_id, photo_file_id=None, video_file_id=None)
+    await update_greeting(tenant_id, kind, video_note_file_id=file_id, photo_file_id=None, video_file_id=None)
 
 async def clear_media(tenant_id: int, kind: str) -> None:
-    await _upsert_full(tenant_id, kind, photo_file_id=None, video_file_id=None, video_note_file_id=None)
+    await update_greeting(tenant_id, kind, photo_file_id=None, video_file_id=None, video_note_file_id=None)
 
 async def set_button_start(tenant_id: int, kind: str, text: str) -> None:
-    await _upsert_full(tenant_id, kind, button_text=text, button_kind="start", button_url=None)
+    await update_greeting(tenant_id, kind, button_text=text, button_kind="start", button_url=None)
 
 async def set_button_url(tenant_id: int, kind: str, text: str, url: str) -> None:
-    await _upsert_full(tenant_id, kind, button_text=text, button_kind="url", button_url=url)
+    await update_greeting(tenant_id, kind, button_text=text, button_kind="url", button_url=url)
 
 async def clear_button(tenant_id: int, kind: str) -> None:
-    await _upsert_full(tenant_id, kind, button_text=None, button_url=None, button_kind="start")
+    await update_greeting(tenant_id, kind, button_text=None, button_url=None, button_kind="start")
@@ -0,0 +1,157 @@
+"""
+Шина инвалидации in-process кэшей между воркерами/хостами через Postgres LISTEN/NOTIFY.
+
+Писатели в *_simple сервисах после записи публикуют (entity, tenant_id) —
+каждый воркер держит одно LISTEN-соединение и выкидывает у себя нужные записи.
+Для кэшей со строковыми ключами (снимок FSM) — отдельный канал: payload в JSON
+со списками изменённых и удалённых ключей.
+После переподключения слушателя кэши сбрасываются целиком: пока соединения не было,
+уведомления могли потеряться.
+"""
+import asyncio
+import json
+import logging
+import secrets
+from typing import Any, Callable, Dict, List, Optional
+
+import asyncpg
+
+from app.db import pg_dsn
+from app.settings import settings
+
+log = logging.getLogger(__name__)
+
+CHANNEL = "cache_invalidate"
+KEYS_CHANNEL = "cache_keys"
+
+# pg_notify принимает payload до 8000 байт — большие наборы ключей режем на части
+_KEYS_PAYLOAD_LIMIT = 7000
+
+# id процесса в payload: свои же уведомления пропускаем — локально уже сбросили
+_INSTANCE = secrets.token_hex(4)
+
+_evictors: Dict[str, List[Callable[[int], None]]] = {}
+_flushers: List[Callable[[], None]] = []
+_key_handlers: Dict[str, List[Callable[[List[str], List[str]], None]]] = {}
+
+
+def subscribe(entity: str, evict: Callable[[int], None], flush_all: Callable[[], None]) -> None:
+    _evictors.setdefault(entity, []).append(evict)
+    _flushers.append(flush_all)
+
+
+async def publish(conn: asyncpg.Connection, entity: str, tenant_id: int) -> None:
+    """Отправляется на том же соединении, что и запись; внутри транзакции — уйдёт на COMMIT."""
+    await conn.execute("SELECT pg_notify($1, $2)", CHANNEL, f"{entity}:{tenant_id}:{_INSTANCE}")
+
+
+def subscribe_keys(
+    entity: str, on_keys: Callable[[List[str], List[str]], None], flush_all: Callable[[], None],
+) -> None:
+    """on_keys(изменённые, удалённые) — ключи, записанные другим процессом."""
+    _key_handlers.setdefault(entity, []).append(on_keys)
+    _flushers.append(flush_all)
+
+
+async def publish_keys(conn: asyncpg.Connection, entity: str, changed: List[str], removed: List[str]) -> None:
+    """Как publish, но для строковых ключей; внутри транзакции — уйдёт на COMMIT."""
+    chunk: Dict[str, Any] = {"e": entity, "o": _INSTANCE, "c": [], "r": []}
+    size = 0
+    for field, keys in (("c", changed), ("r", removed)):
+        for key in keys:
+            if size + len(key) > _KEYS_PAYLOAD_LIMIT:
+                await conn.execute("SELECT pg_notify($1, $2)", KEYS_CHANNEL, json.dumps(chunk))
+                chunk = {"e": entity, "o": _INSTANCE, "c": [], "r": []}
+                size = 0
+            chunk[field].append(key)
+            size += len(key) + 4
+    if size:
+        await conn.execute("SELECT pg_notify($1, $2)", KEYS_CHANNEL, json.dumps(chunk))
+
+
+def _flush_all() -> None:
+    for flush in _flushers:
+        flush()
+
+
+def _on_notify(conn: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+    try:
+        entity, tenant_id, origin = payload.split(":")
+        tid = int(tenant_id)
+    except ValueError:
+        log.warning("bad invalidation payload: %r", payload)
+        return
+    if origin == _INSTANCE:
+        return
+    for evict in _evictors.get(entity, ()):
+        evict(tid)
+
+
+def _on_keys_notify(conn: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+    try:
+        msg = json.loads(payload)
+        entity, origin, changed, removed = msg["e"], msg["o"], msg["c"], msg["r"]
+    except (ValueError, KeyError, TypeError):
+        log.warning("bad keys invalidation payload: %r", payload[:200])
+        return
+    if origin == _INSTANCE:
+        return
+    for on_keys in _key_handlers.get(entity, ()):
+        on_keys(changed, removed)
+
+
+class InvalidationListener:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self.connected = False
+        self.reconnects = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        backoff = 1.0
+        first = True
+        while True:
+            conn: Optional[asyncpg.Connection] = None
+            try:
+                conn = await asyncpg.connect(pg_dsn())
+                await conn.add_listener(CHANNEL, _on_notify)
+                await conn.add_listener(KEYS_CHANNEL, _on_keys_notify)
+                self.connected = True
+                if not first:
+                    self.reconnects += 1
+                    _flush_all()
+                first = False
+                backoff = 1.0
+                # пингуем, чтобы заметить «тихо умершее» соединение
+                while True:
+                    await asyncio.sleep(settings.CACHE_BUS_PING)
+                    await asyncio.wait_for(conn.execute("SELECT 1"), settings.CACHE_BUS_PING)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.warning("invalidation listener lost, retry in %.0fs", backoff, exc_info=True)
+            finally:
+                self.connected = False
+                if conn is not None and not conn.is_closed():
+                    conn.terminate()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, settings.CACHE_BUS_MAX_BACKOFF)
+            first = False
+
+    def stats(self) -> Dict[str, int]:
+        return {"connected": int(self.connected), "reconnects": self.reconnects}
+
+
+listener = InvalidationListener()
@@ -1,9 +1,44 @@
+import asyncio
+import logging
+from typing import Dict
+
 from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from app.services.cache import TTLCache, MISSING
 from app.settings import settings
 
-async def is_in_group(bot: Bot, user_id: int) -> bool:
+log = logging.getLogger(__name__)
+
+_MEMBER_STATUSES = {"creator", "administrator", "member"}
+
+# user_id -> bool; «да» и «нет» живут разное время
+_cache = TTLCache(settings.MEMBERSHIP_POSITIVE_TTL, 50_000)
+# user_id -> идущий запрос: параллельные проверки одного юзера ждут один вызов API
+_inflight: Dict[int, asyncio.Future] = {}
+
+async def _check(bot: Bot, user_id: int) -> bool:
     try:
         cm = await bot.get_chat_member(settings.GROUP_ID, user_id)
-        return getattr(cm, "status", None) in {"creator", "administrator", "member"}
-    except Exception:
+    except TelegramBadRequest:
+        # «user not found» и т.п. — Telegram прямо говорит, что не участник
+        _cache.set(user_id, False, ttl=settings.MEMBERSHIP_NEGATIVE_TTL)
+        return False
+    ok = getattr(cm, "status", None) in _MEMBER_STATUSES
+    _cache.set(user_id, ok, ttl=None if ok else settings.MEMBERSHIP_NEGATIVE_TTL)
+    return ok
+
+async def is_in_group(bot: Bot, user_id: int) -> bool:
+    cached = _cache.get(user_id)
+    if cached is not MISSING:
+        return cached
+    fut = _inflight.get(user_id)
+    if fut is None:
+        fut = _inflight[user_id] = asyncio.ensure_future(_check(bot, user_id))
+        fut.add_done_callback(lambda _: _inflight.pop(user_id, None))
+    try:
+        # shield: отмена одного ожидающего не отменяет общий запрос для остальных
+        return await asyncio.shield(fut)
+    except Exception as e:
+        # сеть/5xx/429 — не кэшируем, следующая проверка сходит в API заново
+        log.warning("membership check for %s failed: %s", user_id, e)
         return False
@@ -1,11 +1,14 @@
-import asyncpg
-from typing import List, Dict, Any, Optional
+import asyncio
+import logging
+import weakref
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
 from datetime import datetime, timezone
+from app.db import pg
 from app.settings import settings
 
-def _dsn() -> str:
-    return settings.DATABASE_URL.replace("+asyncpg", "")
+log = logging.getLogger(__name__)
 
+# DDL применяется один раз на старте: app.services.schema.ensure_schema
 CREATE_TABLE_SQL = """
 CREATE TABLE IF NOT EXISTS pending_requests (
   id SERIAL PRIMARY KEY,
@@ -18,60 +21,183 @@ CREATE TABLE IF NOT EXISTS pending_requests (
   error TEXT
 );
 
-CREATE INDEX IF NOT EXISTS idx_pending_tenant_status ON pending_requests(tenant_id, status);
 CREATE INDEX IF NOT EXISTS idx_pending_tenant_user   ON pending_requests(tenant_id, user_id);
-"""
 
-async def ensure_schema():
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
-        for stmt in CREATE_TABLE_SQL.strip().split(";\n\n"):
-            if stmt.strip():
-                await conn.execute(stmt)
-    finally:
-        await conn.close()
+-- перед уникальным индексом один раз чистим накопившиеся дубли (оставляем самую раннюю заявку)
+DO $$
+BEGIN
+  IF to_regclass('uq_pending_new') IS NULL THEN
+    DELETE FROM pending_requests p USING pending_requests d
+    WHERE p.status = 'new' AND d.status = 'new'
+      AND p.tenant_id = d.tenant_id AND p.chat_id = d.chat_id AND p.user_id = d.user_id
+      AND p.id > d.id;
+  END IF;
+END $$;
+
+-- одна «новая» заявка на (тенант, чат, пользователь); индексы покрывают только очередь,
+-- поэтому не растут вместе с историей approved/failed
+CREATE UNIQUE INDEX IF NOT EXISTS uq_pending_new ON pending_requests(tenant_id, chat_id, user_id) WHERE status = 'new';
+CREATE INDEX IF NOT EXISTS idx_pending_new_queue ON pending_requests(tenant_id, requested_at, id) WHERE status = 'new';
+DROP INDEX IF EXISTS idx_pending_tenant_status;
+"""
 
 async def add_request(tenant_id: int, chat_id: int, user_id: int) -> None:
-    await ensure_schema()
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
+    # повторная заявка того же пользователя в тот же чат не дублируется и сохраняет место в очереди
+    async with pg() as conn:
         await conn.execute(
-            "INSERT INTO pending_requests(tenant_id, chat_id, user_id) VALUES($1,$2,$3)",
+            "INSERT INTO pending_requests(tenant_id, chat_id, user_id) VALUES($1,$2,$3) "
+            "ON CONFLICT (tenant_id, chat_id, user_id) WHERE status = 'new' DO NOTHING",
             tenant_id, chat_id, user_id
         )
-    finally:
-        await conn.close()
 
 async def list_new(tenant_id: int, limit: int = 500) -> List[Dict[str, Any]]:
-    await ensure_schema()
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
+    async with pg() as conn:
         rows = await conn.fetch(
-            "SELECT * FROM pending_requests WHERE tenant_id=$1 AND status='new' ORDER BY requested_at ASC LIMIT $2",
+            "SELECT * FROM pending_requests WHERE tenant_id=$1 AND status='new' ORDER BY requested_at, id LIMIT $2",
             tenant_id, limit
         )
         return [dict(r) for r in rows]
-    finally:
-        await conn.close()
+
+async def iter_new(tenant_id: int, page_size: int = 500) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Все новые заявки тенанта страницами по keyset (requested_at, id) — без лимита на общий объём.
+    Соединение берём только на время выборки страницы, в памяти — не больше page_size строк.
+    """
+    last: Optional[Tuple[datetime, int]] = None
+    while True:
+        async with pg() as conn:
+            if last is None:
+                rows = await conn.fetch(
+                    "SELECT id, chat_id, user_id, requested_at FROM pending_requests "
+                    "WHERE tenant_id=$1 AND status='new' "
+                    "ORDER BY requested_at, id LIMIT $2",
+                    tenant_id, page_size
+                )
+            else:
+                rows = await conn.fetch(
+                    "SELECT id, chat_id, user_id, requested_at FROM pending_requests "
+                    "WHERE tenant_id=$1 AND status='new' AND (requested_at, id) > ($2, $3) "
+                    "ORDER BY requested_at, id LIMIT $4",
+                    tenant_id, last[0], last[1], page_size
+                )
+        for r in rows:
+            yield {"id": r["id"], "chat_id": r["chat_id"], "user_id": r["user_id"]}
+        if len(rows) < page_size:
+            return
+        last = (rows[-1]["requested_at"], rows[-1]["id"])
 
 async def mark_approved(row_id: int, dm_ok: Optional[bool], error: Optional[str]) -> None:
-    await ensure_schema()
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
+    async with pg() as conn:
         await conn.execute(
             "UPDATE pending_requests SET status='approved', dm_ok=$1, error=$2 WHERE id=$3",
             dm_ok, error, row_id
         )
-    finally:
-        await conn.close()
 
 async def mark_failed(row_id: int, error: str) -> None:
-    await ensure_schema()
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
+    async with pg() as conn:
         await conn.execute(
             "UPDATE pending_requests SET status='failed', error=$1 WHERE id=$2",
             error, row_id
         )
-    finally:
-        await conn.close()
+
+
+# ===== пакетная запись статусов =====
+
+_BATCH_UPDATE_SQL = """
+UPDATE pending_requests AS p
+SET status = u.status, dm_ok = u.dm_ok, error = u.error
+FROM unnest($1::int[], $2::text[], $3::bool[], $4::text[]) AS u(id, status, dm_ok, error)
+WHERE p.id = u.id
+"""
+
+# живые writer'ы — чтобы дописать их буферы при остановке сервиса
+_writers: "weakref.WeakSet[StatusWriter]" = weakref.WeakSet()
+# закрытые с недописанным буфером — держим сильной ссылкой до flush_all_writers
+_unflushed: "set[StatusWriter]" = set()
+
+class StatusWriter:
+    """
+    Копит итоги по заявкам и пишет их одним UPDATE ... FROM unnest(...):
+    при наборе batch_size строк или раз в interval секунд, плюс на выходе.
+
+        async with StatusWriter() as w:
+            await w.approved(row_id, dm_ok=True)
+    """
+    def __init__(self, batch_size: Optional[int] = None, interval: Optional[float] = None):
+        self.batch_size = batch_size or settings.PENDING_FLUSH_SIZE
+        self.interval = interval or settings.PENDING_FLUSH_INTERVAL
+        self._buf: List[Tuple[int, str, Optional[bool], Optional[str]]] = []
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        _writers.add(self)
+
+    async def approved(self, row_id: int, dm_ok: Optional[bool], error: Optional[str] = None) -> None:
+        await self._add((row_id, "approved", dm_ok, error))
+
+    async def failed(self, row_id: int, error: str) -> None:
+        await self._add((row_id, "failed", None, error))
+
+    async def _add(self, item: Tuple[int, str, Optional[bool], Optional[str]]) -> None:
+        self._buf.append(item)
+        if len(self._buf) >= self.batch_size:
+            # ошибку записи вызывающему не отдаём: пачка осталась в буфере,
+            # её допишет таймер или close()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("pending status flush failed, %s rows kept", len(self._buf))
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._buf:
+                return
+            batch, self._buf = self._buf, []
+            try:
+                async with pg() as conn:
+                    await conn.execute(
+                        _BATCH_UPDATE_SQL,
+                        [b[0] for b in batch], [b[1] for b in batch],
+                        [b[2] for b in batch], [b[3] for b in batch],
+                    )
+            except Exception:
+                # вернём в буфер — допишем следующим flush
+                self._buf[:0] = batch
+                raise
+
+    async def _tick(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("pending status flush failed")
+
+    async def __aenter__(self) -> "StatusWriter":
+        self._timer = asyncio.create_task(self._tick())
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        try:
+            await self.flush()
+        except Exception:
+            # не перебиваем исключение/отмену вызывающего; допишем на shutdown
+            log.exception("pending status flush on close failed, %s rows kept", len(self._buf))
+            _unflushed.add(self)
+            return
+        _writers.discard(self)
+        _unflushed.discard(self)
+
+async def flush_all_writers() -> None:
+    for w in {*_writers, *_unflushed}:
+        try:
+            await w.flush()
+        except Exception:
+            log.exception("pending status flush on shutdown failed")
+            continue
+        _unflushed.discard(w)
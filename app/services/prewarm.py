@@ -0,0 +1,42 @@
+"""
+Прогрев кэшей на старте: все активные тенанты, их приветствия и флаги грузятся
+пачками (по три запроса на PREWARM_PAGE тенантов), а не по одному на первом апдейте.
+Заодно создаются Bot-объекты в реестре — первый апдейт после деплоя идёт по тёплому пути.
+"""
+import logging
+import time
+from typing import Callable, Dict, Optional
+
+from app.bots.registry import child_bots
+from app.services.greetings_simple import prewarm_send_plans
+from app.services.settings_simple import prewarm_settings
+from app.services.tenants_simple import prewarm_tenant_auth
+from app.settings import settings
+
+log = logging.getLogger(__name__)
+
+
+async def prewarm(owns: Optional[Callable[[int], bool]] = None) -> Dict[str, float]:
+    """
+    owns(tenant_id) — греть только «своих» тенантов (воркер в многопроцессном режиме).
+    Не больше TENANT_CACHE_MAX тенантов: дальше кэш всё равно начнёт вытеснять.
+    """
+    started = time.monotonic()
+    tenants, greetings, after_id = 0, 0, 0
+    while tenants < settings.TENANT_CACHE_MAX:
+        page = await prewarm_tenant_auth(after_id, settings.PREWARM_PAGE)
+        if not page:
+            break
+        after_id = page[-1].id
+        mine = [a for a in page if owns is None or owns(a.id)]
+        ids = [a.id for a in mine]
+        greetings += await prewarm_send_plans(ids)
+        await prewarm_settings(ids)
+        for auth in mine[: max(0, settings.CHILD_BOTS_MAX - tenants)]:
+            child_bots.get(auth.id, auth.bot_token)
+        tenants += len(mine)
+        if len(page) < settings.PREWARM_PAGE:
+            break
+    elapsed = time.monotonic() - started
+    log.info("prewarm: %s tenants, %s greetings in %.2fs", tenants, greetings, elapsed)
+    return {"tenants": tenants, "greetings": greetings, "seconds": round(elapsed, 3)}
@@ -0,0 +1,64 @@
+"""
+Лимитеры запросов к Bot API: token bucket на бота + уважение retry_after из 429.
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from aiogram.exceptions import TelegramRetryAfter
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # под локом — ждущие обслуживаются по очереди (FIFO)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Telegram ответил 429 — стопорим всех, кто ходит через этот bucket."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+async def tg_call(bucket: TokenBucket, fn: Callable[[], Awaitable[T]], attempts: int = 3) -> T:
+    """Вызов Bot API через лимитер; на 429 ждём retry_after и повторяем."""
+    for attempt in range(attempts):
+        await bucket.acquire()
+        try:
+            return await fn()
+        except TelegramRetryAfter as e:
+            bucket.pause(e.retry_after)
+            if attempt == attempts - 1:
+                raise
+    raise RuntimeError("unreachable")
+
+
+# (bot_id, вид) -> bucket; вид: "api" — апрувы и прочие вызовы, "dm" — сообщения в ЛС
+_buckets: Dict[tuple[int, str], TokenBucket] = {}
+
+def bot_bucket(bot_id: int, kind: str, rate: float) -> TokenBucket:
+    key = (bot_id, kind)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = _buckets[key] = TokenBucket(rate)
+    return bucket
@@ -0,0 +1,37 @@
+"""
+Разовый бутстрап схемы для таблиц, которые живут вне моделей SQLAlchemy
+(pending_requests, tenant_settings, ...) или дополняются (stats_daily). Запускается один раз на старте,
+после этого горячие пути делают ровно по одному запросу без DDL.
+"""
+from app.db import pg
+from app.services import pending, settings_simple, stats, broadcast, tenants_simple
+from app.bots import fsm_storage, polling
+
+# Одинаковый ключ для всех воркеров: DDL выполняет только один из них за раз
+_SCHEMA_LOCK_KEY = 0x6D62_0001
+
+_SCHEMA_SQL = (
+    tenants_simple.CREATE_INDEX_SQL,
+    pending.CREATE_TABLE_SQL,
+    settings_simple.CREATE_TABLE_SQL,
+    stats.CREATE_TABLE_SQL,
+    broadcast.CREATE_TABLE_SQL,
+    fsm_storage.CREATE_TABLE_SQL,
+    polling.CREATE_TABLE_SQL,
+)
+
+_ready = False
+
+def is_ready() -> bool:
+    return _ready
+
+async def ensure_schema() -> None:
+    global _ready
+    if _ready:
+        return
+    async with pg() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _SCHEMA_LOCK_KEY)
+            for sql in _SCHEMA_SQL:
+                await conn.execute(sql)
+    _ready = True
@@ -1,10 +1,10 @@
-import asyncpg
-from typing import Optional
+from typing import Any, Dict, List
+from app.db import pg
+from app.services.cache import TTLCache, MISSING
+from app.services.invalidation import subscribe, publish
 from app.settings import settings
 
-def _dsn() -> str:
-    return settings.DATABASE_URL.replace("+asyncpg", "")
-
+# DDL применяется один раз на старте: app.services.schema.ensure_schema
 CREATE_TABLE_SQL = """
 CREATE TABLE IF NOT EXISTS tenant_settings (
   tenant_id INTEGER PRIMARY KEY,
@@ -12,39 +12,71 @@ CREATE TABLE IF NOT EXISTS tenant_settings (
 );
 """
 
-async def ensure_schema():
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
-        await conn.execute(CREATE_TABLE_SQL)
-    finally:
-        await conn.close()
+# значения по умолчанию, пока у тенанта нет строки в tenant_settings
+_DEFAULTS: Dict[str, Any] = {"collect_requests": False}
+
+# tenant_id -> {флаг: значение}; запись — write-through (кладём то, что вернул RETURNING)
+_cache = TTLCache(settings.SETTINGS_CACHE_TTL, settings.SETTINGS_CACHE_MAX)
+
+def _remember(tenant_id: int, row: Any) -> Dict[str, Any]:
+    value = dict(_DEFAULTS)
+    if row:
+        value.update({k: v for k, v in dict(row).items() if k != "tenant_id"})
+    _cache.set(tenant_id, value)
+    return value
+
+def invalidate_settings(tenant_id: int) -> None:
+    _cache.pop(tenant_id)
+
+subscribe("settings", invalidate_settings, _cache.clear)
+
+async def prewarm_settings(tenant_ids: List[int]) -> None:
+    """Флаги пачки тенантов одним запросом; без строки в tenant_settings — дефолты."""
+    if not tenant_ids:
+        return
+    async with pg() as conn:
+        rows = await conn.fetch("SELECT * FROM tenant_settings WHERE tenant_id = ANY($1::int[])", tenant_ids)
+    found = {int(r["tenant_id"]): r for r in rows}
+    for tid in tenant_ids:
+        _remember(tid, found.get(tid))
+
+async def get_tenant_settings(tenant_id: int) -> Dict[str, Any]:
+    """Все флаги тенанта; в установившемся режиме — из кэша, без запросов в БД."""
+    cached = _cache.get(tenant_id)
+    if cached is not MISSING:
+        return cached
+    async with pg() as conn:
+        row = await conn.fetchrow("SELECT * FROM tenant_settings WHERE tenant_id=$1", tenant_id)
+    return _remember(tenant_id, row)
 
 async def get_collect_requests(tenant_id: int) -> bool:
-    await ensure_schema()
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
-        row = await conn.fetchrow("SELECT collect_requests FROM tenant_settings WHERE tenant_id=$1", tenant_id)
-        return bool(row["collect_requests"]) if row else False
-    finally:
-        await conn.close()
+    return bool((await get_tenant_settings(tenant_id))["collect_requests"])
 
 async def set_collect_requests(tenant_id: int, value: bool) -> None:
-    await ensure_schema()
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
-        await conn.execute(
+    async with pg() as conn:
+        row = await conn.fetchrow(
             """
             INSERT INTO tenant_settings(tenant_id, collect_requests)
             VALUES($1, $2)
             ON CONFLICT (tenant_id) DO UPDATE SET collect_requests=EXCLUDED.collect_requests
+            RETURNING *
             """,
             tenant_id, value,
         )
-    finally:
-        await conn.close()
+        await publish(conn, "settings", tenant_id)
+    _remember(tenant_id, row)
 
 async def toggle_collect_requests(tenant_id: int) -> bool:
-    cur = await get_collect_requests(tenant_id)
-    nxt = not cur
-    await set_collect_requests(tenant_id, nxt)
-    return nxt
+    # одним запросом: нет строки — создаём с TRUE (по умолчанию было FALSE), есть — инвертируем
+    async with pg() as conn:
+        row = await conn.fetchrow(
+            """
+            INSERT INTO tenant_settings(tenant_id, collect_requests)
+            VALUES($1, TRUE)
+            ON CONFLICT (tenant_id) DO UPDATE SET collect_requests = NOT tenant_settings.collect_requests
+            RETURNING *
+            """,
+            tenant_id,
+        )
+        await publish(conn, "settings", tenant_id)
+    return bool(_remember(tenant_id, row)["collect_requests"])
@@ -0,0 +1,227 @@
+"""
+Дневная статистика тенантов: счётчики копятся в памяти и раз в STATS_FLUSH_INTERVAL
+секунд уходят в stats_daily одним INSERT ... ON CONFLICT DO UPDATE (инкрементом).
+На горячем пути событий — ноль запросов в БД.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.db import pg
+from app.services.cache import TTLCache, MISSING
+from app.settings import settings
+
+log = logging.getLogger(__name__)
+
+FIELDS = ("joins", "leaves", "approvals", "dm_ok", "dm_failed")
+_IDX = {name: i for i, name in enumerate(FIELDS)}
+
+# DDL применяется один раз на старте: app.services.schema.ensure_schema
+CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS stats_daily (
+  id SERIAL PRIMARY KEY,
+  tenant_id INTEGER NOT NULL REFERENCES tenants(id) ON DELETE CASCADE,
+  day VARCHAR(10) NOT NULL,             -- YYYY-MM-DD (UTC)
+  joins INTEGER NOT NULL DEFAULT 0,
+  leaves INTEGER NOT NULL DEFAULT 0,
+  approvals INTEGER NOT NULL DEFAULT 0,
+  CONSTRAINT uq_stats_tenant_day UNIQUE (tenant_id, day)
+);
+
+ALTER TABLE stats_daily ADD COLUMN IF NOT EXISTS dm_ok INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE stats_daily ADD COLUMN IF NOT EXISTS dm_failed INTEGER NOT NULL DEFAULT 0;
+
+-- покрывающие индексы: диапазоны по тенанту и «все тенанты за период» читаются index-only
+CREATE INDEX IF NOT EXISTS idx_stats_tenant_day_cov ON stats_daily(tenant_id, day)
+  INCLUDE (joins, leaves, approvals, dm_ok, dm_failed);
+CREATE INDEX IF NOT EXISTS idx_stats_day_tenant_cov ON stats_daily(day, tenant_id)
+  INCLUDE (joins, leaves, approvals, dm_ok, dm_failed);
+"""
+
+# строки удалённых тенантов отбрасываем, иначе FK уронит всю пачку
+_FLUSH_SQL = """
+INSERT INTO stats_daily (tenant_id, day, joins, leaves, approvals, dm_ok, dm_failed)
+SELECT u.tenant_id, u.day, u.joins, u.leaves, u.approvals, u.dm_ok, u.dm_failed
+FROM unnest($1::int[], $2::text[], $3::int[], $4::int[], $5::int[], $6::int[], $7::int[])
+     AS u(tenant_id, day, joins, leaves, approvals, dm_ok, dm_failed)
+WHERE EXISTS (SELECT 1 FROM tenants t WHERE t.id = u.tenant_id)
+ON CONFLICT (tenant_id, day) DO UPDATE SET
+  joins = stats_daily.joins + EXCLUDED.joins,
+  leaves = stats_daily.leaves + EXCLUDED.leaves,
+  approvals = stats_daily.approvals + EXCLUDED.approvals,
+  dm_ok = stats_daily.dm_ok + EXCLUDED.dm_ok,
+  dm_failed = stats_daily.dm_failed + EXCLUDED.dm_failed
+"""
+
+# (tenant_id, day) -> [joins, leaves, approvals, dm_ok, dm_failed]
+_counters: Dict[Tuple[int, str], List[int]] = {}
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def incr(tenant_id: int, field: str, n: int = 1) -> None:
+    key = (tenant_id, _today())
+    row = _counters.get(key)
+    if row is None:
+        row = _counters[key] = [0] * len(FIELDS)
+    row[_IDX[field]] += n
+
+
+def record_dm(tenant_id: int, delivered: bool) -> None:
+    incr(tenant_id, "dm_ok" if delivered else "dm_failed")
+
+
+def pending_counters() -> Dict[Tuple[int, str], List[int]]:
+    """Ещё не записанные в БД приращения (для «живых» цифр на экране статистики)."""
+    return _counters
+
+
+async def flush() -> None:
+    global _counters
+    if not _counters:
+        return
+    batch, _counters = _counters, {}
+    keys = list(batch)
+    try:
+        async with pg() as conn:
+            await conn.execute(
+                _FLUSH_SQL,
+                [k[0] for k in keys], [k[1] for k in keys],
+                *([batch[k][i] for k in keys] for i in range(len(FIELDS))),
+            )
+        # иначе кэш экранов на пару минут «потеряет» только что записанное
+        _render_cache.clear()
+    except Exception:
+        # не теряем приращения — сложим обратно к тому, что успело накопиться
+        for key, values in batch.items():
+            row = _counters.setdefault(key, [0] * len(FIELDS))
+            for i, v in enumerate(values):
+                row[i] += v
+        raise
+
+
+# ===== запросы для экранов статистики =====
+
+# короткий кэш отрисовки: листание экранов не бьёт в БД каждый раз
+_render_cache = TTLCache(settings.STATS_CACHE_TTL, 5_000)
+
+_SUMS = ", ".join(f"COALESCE(SUM({f}), 0)::int AS {f}" for f in FIELDS)
+
+
+def _since(days: int) -> str:
+    return (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+
+
+def _add_unflushed(totals: Dict[str, int], tenant_id: Optional[int], since: str) -> Dict[str, int]:
+    for (tid, day), values in _counters.items():
+        if day >= since and (tenant_id is None or tid == tenant_id):
+            for name, v in zip(FIELDS, values):
+                totals[name] += v
+    return totals
+
+
+async def range_totals(tenant_id: Optional[int], days: int) -> Dict[str, int]:
+    """Суммы за последние days дней (включая сегодня). tenant_id=None — по всем тенантам."""
+    key = ("totals", tenant_id, days)
+    cached = _render_cache.get(key)
+    if cached is MISSING:
+        since = _since(days)
+        async with pg() as conn:
+            if tenant_id is None:
+                row = await conn.fetchrow(f"SELECT {_SUMS} FROM stats_daily WHERE day >= $1", since)
+            else:
+                row = await conn.fetchrow(
+                    f"SELECT {_SUMS} FROM stats_daily WHERE tenant_id=$1 AND day >= $2",
+                    tenant_id, since,
+                )
+        cached = dict(row)
+        _render_cache.set(key, cached)
+    # ещё не сброшенные счётчики добавляем поверх — цифры «живые» даже из кэша
+    return _add_unflushed(dict(cached), tenant_id, _since(days))
+
+
+async def daily_series(tenant_id: int, days: int) -> List[Tuple[str, Dict[str, int]]]:
+    """По дням за последние days дней, дни без событий — нулями. Новые дни первыми."""
+    key = ("series", tenant_id, days)
+    cached = _render_cache.get(key)
+    if cached is MISSING:
+        async with pg() as conn:
+            rows = await conn.fetch(
+                f"SELECT day, {', '.join(FIELDS)} FROM stats_daily "
+                "WHERE tenant_id=$1 AND day >= $2",
+                tenant_id, _since(days),
+            )
+        by_day = {r["day"]: {f: int(r[f]) for f in FIELDS} for r in rows}
+        today = datetime.now(timezone.utc)
+        cached = []
+        for i in range(days):
+            day = (today - timedelta(days=i)).strftime("%Y-%m-%d")
+            cached.append((day, by_day.get(day) or {f: 0 for f in FIELDS}))
+        _render_cache.set(key, cached)
+    # как и в range_totals: несброшенные счётчики поверх, по своему дню
+    out = []
+    for day, values in cached:
+        totals = dict(values)
+        for name, v in zip(FIELDS, _counters.get((tenant_id, day), ())):
+            totals[name] += v
+        out.append((day, totals))
+    return out
+
+
+async def top_tenants(days: int, limit: int = 10) -> List[Dict[str, Any]]:
+    """Топ тенантов по заявкам за период: читаем только строки периода по (day, tenant_id)."""
+    key = ("top", days, limit)
+    cached = _render_cache.get(key)
+    if cached is MISSING:
+        async with pg() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT t.id, t.owner_user_id, t.owner_username, t.bot_username, s.joins, s.approvals
+                FROM (
+                    SELECT tenant_id, SUM(joins)::int AS joins, SUM(approvals)::int AS approvals
+                    FROM stats_daily WHERE day >= $1
+                    GROUP BY tenant_id
+                    ORDER BY joins DESC
+                    LIMIT $2
+                ) s
+                JOIN tenants t ON t.id = s.tenant_id
+                ORDER BY s.joins DESC
+                """,
+                _since(days), limit,
+            )
+        cached = [dict(r) for r in rows]
+        _render_cache.set(key, cached)
+    return cached
+
+
+class StatsFlusher:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(settings.STATS_FLUSH_INTERVAL)
+            try:
+                await flush()
+            except Exception:
+                log.exception("stats flush failed")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await flush()
+
+
+flusher = StatsFlusher()
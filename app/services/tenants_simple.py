@@ -1,20 +1,101 @@
+import hashlib
+import hmac
 import secrets
-import asyncpg
+from dataclasses import dataclass
 from typing import Optional, List, Tuple, Dict, Any
+from app.db import pg
+from app.services.cache import TTLCache, MISSING
+from app.services.invalidation import subscribe, publish
 from app.settings import settings
 
-def _dsn() -> str:
-    return settings.DATABASE_URL.replace("+asyncpg", "")
+# === Кэш авторизации для вебхука ===
+
+def _secret_hash(secret: str) -> bytes:
+    return hashlib.sha256(secret.encode()).digest()
+
+@dataclass(frozen=True, slots=True)
+class TenantAuth:
+    id: int
+    owner_user_id: int
+    bot_token: str
+    secret_hash: bytes
+    is_active: bool
+
+    def check_secret(self, secret: str) -> bool:
+        # сравнение за константное время
+        return hmac.compare_digest(self.secret_hash, _secret_hash(secret))
+
+# tenant_id -> TenantAuth | None (None — тенанта нет, тоже кэшируем)
+_auth_cache = TTLCache(settings.TENANT_CACHE_TTL, settings.TENANT_CACHE_MAX)
+
+def invalidate_tenant_auth(tenant_id: int) -> None:
+    _auth_cache.pop(tenant_id)
+    # состав тенантов мог поменяться — пересчитаем total для списка
+    _count_cache.clear()
+
+def _flush_tenant_caches() -> None:
+    _auth_cache.clear()
+    _count_cache.clear()
+
+# общее число тенантов для «стр. X из Y»
+_count_cache = TTLCache(settings.TENANT_COUNT_TTL, 1)
+
+subscribe("tenant", invalidate_tenant_auth, _flush_tenant_caches)
+
+# DDL применяется один раз на старте: app.services.schema.ensure_schema
+# (сама таблица tenants — из моделей; тут индексы под поиск в GA и колонка
+# webhook_error, добавленная позже таблицы)
+CREATE_INDEX_SQL = """
+ALTER TABLE tenants ADD COLUMN IF NOT EXISTS webhook_error TEXT;
+CREATE INDEX IF NOT EXISTS idx_tenants_owner_username_lower ON tenants (lower(owner_username) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_tenants_bot_username_lower ON tenants (lower(bot_username) text_pattern_ops);
+"""
+
+async def get_tenant_auth(tenant_id: int) -> Optional[TenantAuth]:
+    """
+    Всё, что нужно вебхуку, чтобы проверить апдейт и достать бота.
+    В установившемся режиме — ноль запросов в БД.
+    """
+    cached = _auth_cache.get(tenant_id)
+    if cached is not MISSING:
+        return cached
+    async with pg() as conn:
+        row = await conn.fetchrow(
+            "SELECT id, owner_user_id, bot_token, secret, is_active FROM tenants WHERE id=$1",
+            tenant_id,
+        )
+    auth = _auth_from_row(row) if row else None
+    _auth_cache.set(tenant_id, auth)
+    return auth
+
+def _auth_from_row(row: Any) -> TenantAuth:
+    return TenantAuth(
+        id=int(row["id"]),
+        owner_user_id=int(row["owner_user_id"]),
+        bot_token=row["bot_token"],
+        secret_hash=_secret_hash(row["secret"]),
+        is_active=bool(row["is_active"]),
+    )
+
+async def prewarm_tenant_auth(after_id: int, limit: int) -> List[TenantAuth]:
+    """Страница активных тенантов (id > after_id) одним запросом — сразу в кэш авторизации."""
+    async with pg() as conn:
+        rows = await conn.fetch(
+            "SELECT id, owner_user_id, bot_token, secret, is_active FROM tenants "
+            "WHERE is_active AND id > $1 ORDER BY id LIMIT $2",
+            after_id, limit,
+        )
+    out = [_auth_from_row(r) for r in rows]
+    for auth in out:
+        _auth_cache.set(auth.id, auth)
+    return out
 
 # === CRUD для GA и подключения ===
 
 async def get_tenant_by_owner(owner_user_id: int) -> Optional[Dict[str, Any]]:
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
+    async with pg() as conn:
         row = await conn.fetchrow("SELECT * FROM tenants WHERE owner_user_id=$1", owner_user_id)
         return dict(row) if row else None
-    finally:
-        await conn.close()
 
 async def upsert_tenant(owner_user_id: int, owner_username: Optional[str], bot_token: str) -> Tuple[int, str]:
     """
@@ -26,48 +107,95 @@ async def upsert_tenant(owner_user_id: int, owner_username: Optional[str], bot_t
         return existing["id"], existing["secret"]
 
     secret = secrets.token_urlsafe(16)
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
+    async with pg() as conn:
         tenant_id = await conn.fetchval(
             "INSERT INTO tenants(owner_user_id, owner_username, bot_token, secret, is_active) "
             "VALUES($1,$2,$3,$4,TRUE) RETURNING id",
             owner_user_id, owner_username, bot_token, secret
         )
-    finally:
-        await conn.close()
+        await publish(conn, "tenant", tenant_id)
+    invalidate_tenant_auth(tenant_id)
     return tenant_id, secret
 
 async def save_bot_username(tenant_id: int, username: str):
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
+    async with pg() as conn:
         await conn.execute("UPDATE tenants SET bot_username=$1 WHERE id=$2", username, tenant_id)
-    finally:
-        await conn.close()
 
 async def get_tenant(tenant_id: int) -> Optional[Dict[str, Any]]:
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
+    async with pg() as conn:
         row = await conn.fetchrow("SELECT * FROM tenants WHERE id=$1", tenant_id)
         return dict(row) if row else None
-    finally:
-        await conn.close()
 
-async def list_tenants(page: int, page_size: int = 10) -> List[Dict[str, Any]]:
-    offset = (page-1) * page_size
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
-        rows = await conn.fetch(
-            "SELECT id, owner_user_id, owner_username, bot_username, is_active "
-            "FROM tenants ORDER BY id DESC LIMIT $1 OFFSET $2",
-            page_size+1, offset
-        )
-        return [dict(r) for r in rows]
-    finally:
-        await conn.close()
+_LIST_COLUMNS = "id, owner_user_id, owner_username, bot_username, is_active"
+
+async def list_tenants_page(
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    page_size: int = 10,
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Страница списка (новые сверху) по keyset на id — глубокие страницы стоят как первая.
+    after_id — следующая страница (id < after_id), before_id — предыдущая (id > before_id).
+    Возвращает (строки, есть ли ещё в ту же сторону).
+    """
+    async with pg() as conn:
+        if before_id is not None:
+            rows = await conn.fetch(
+                f"SELECT {_LIST_COLUMNS} FROM tenants WHERE id > $1 ORDER BY id ASC LIMIT $2",
+                before_id, page_size + 1,
+            )
+            more = len(rows) > page_size
+            return [dict(r) for r in reversed(rows[:page_size])], more
+        if after_id is not None:
+            rows = await conn.fetch(
+                f"SELECT {_LIST_COLUMNS} FROM tenants WHERE id < $1 ORDER BY id DESC LIMIT $2",
+                after_id, page_size + 1,
+            )
+        else:
+            rows = await conn.fetch(
+                f"SELECT {_LIST_COLUMNS} FROM tenants ORDER BY id DESC LIMIT $1",
+                page_size + 1,
+            )
+    return [dict(r) for r in rows[:page_size]], len(rows) > page_size
+
+async def count_tenants() -> int:
+    cached = _count_cache.get("total")
+    if cached is MISSING:
+        async with pg() as conn:
+            cached = int(await conn.fetchval("SELECT COUNT(*) FROM tenants"))
+        _count_cache.set("total", cached)
+    return cached
+
+async def search_tenants(query: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """
+    Поиск по началу @owner_username / @bot_username (без учёта регистра, по индексам),
+    либо по числу — id тенанта или owner_user_id.
+    """
+    q = query.strip().lstrip("@").lower()
+    if not q:
+        return []
+    async with pg() as conn:
+        if q.isdigit():
+            rows = await conn.fetch(
+                f"SELECT {_LIST_COLUMNS} FROM tenants WHERE id = $1::bigint OR owner_user_id = $1::bigint "
+                "ORDER BY id DESC LIMIT $2",
+                int(q), limit,
+            )
+        else:
+            # префикс как диапазон [q, q′) операторами text_pattern_ops — индекс
+            # используется и в generic-плане подготовленного запроса (в отличие от LIKE $1)
+            upper = q[:-1] + chr(ord(q[-1]) + 1)
+            rows = await conn.fetch(
+                f"SELECT {_LIST_COLUMNS} FROM tenants "
+                "WHERE (lower(owner_username) ~>=~ $1 AND lower(owner_username) ~<~ $2) "
+                "   OR (lower(bot_username) ~>=~ $1 AND lower(bot_username) ~<~ $2) "
+                "ORDER BY id DESC LIMIT $3",
+                q, upper, limit,
+            )
+    return [dict(r) for r in rows]
 
 async def delete_tenant(tenant_id: int):
-    conn = await asyncpg.connect(dsn=_dsn())
-    try:
+    async with pg() as conn:
         await conn.execute("DELETE FROM tenants WHERE id=$1", tenant_id)
-    finally:
-        await conn.close()
+        await publish(conn, "tenant", tenant_id)
+    invalidate_tenant_auth(tenant_id)
@@ -1,12 +1,47 @@
+import os
+from typing import Optional
+
 from aiogram import Bot
-from aiogram.types import FSInputFile
+from aiogram.types import BufferedInputFile
 from app.settings import settings
 
-async def set_ga_webhook(bot: Bot):
-    cert = FSInputFile(settings.CERT_PATH)
+GA_ALLOWED_UPDATES = ["message","callback_query","chat_join_request","chat_member","my_chat_member"]
+
+# сертификат читаем с диска один раз на процесс (общий для GA и детских ботов);
+# массовая пересинхронизация перечитывает его — на случай замены файла
+_cert: Optional[BufferedInputFile] = None
+_cert_loaded = False
+
+def load_certificate(reload: bool = False) -> Optional[BufferedInputFile]:
+    global _cert, _cert_loaded
+    if reload or not _cert_loaded:
+        _cert = None
+        if settings.CERT_PATH and os.path.exists(settings.CERT_PATH):
+            with open(settings.CERT_PATH, "rb") as f:
+                _cert = BufferedInputFile(f.read(), filename=os.path.basename(settings.CERT_PATH))
+        _cert_loaded = True
+    return _cert
+
+async def set_ga_webhook(bot: Bot, force: bool = False) -> bool:
+    """
+    Ставит вебхук GA, только если в Telegram сейчас другой. False — уже актуален.
+    force — без сверки (замену сертификата getWebhookInfo не покажет).
+    Очередь апдейтов не сбрасываем: то, что пришло во время рестарта, обработаем.
+    """
+    url = f"{settings.WEB_BASE}/webhook/ga"
+    cert = load_certificate()
+    info = None if force else await bot.get_webhook_info()
+    if (
+        info is not None
+        and info.url == url
+        and bool(info.has_custom_certificate) == (cert is not None)
+        and set(info.allowed_updates or ()) == set(GA_ALLOWED_UPDATES)
+    ):
+        return False
     await bot.set_webhook(
-        url=f"{settings.WEB_BASE}/webhook/ga",
-        drop_pending_updates=True,
-        allowed_updates=["message","callback_query","chat_join_request","chat_member","my_chat_member","chat_member_updated"],
+        url=url,
+        drop_pending_updates=False,
+        allowed_updates=GA_ALLOWED_UPDATES,
         certificate=cert,
     )
+    return True
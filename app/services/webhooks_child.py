@@ -1,14 +1,125 @@
+"""
+Вебхуки детских ботов: установка при подключении и массовая пересинхронизация
+(смена WEB_BASE или сертификата) — из GA-бота и из CLI (python -m app.cli resync-webhooks).
+"""
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
 from aiogram import Bot
-from aiogram.types import FSInputFile
+from aiogram.exceptions import TelegramRetryAfter
+
+from app.bots.registry import child_bots
+from app.db import pg
+from app.services.ratelimit import TokenBucket, tg_call
+from app.services.webhooks import load_certificate
 from app.settings import settings
 
-CERT_PATH = "/etc/ssl/certs/multibot.crt"
+log = logging.getLogger(__name__)
+
+ALLOWED_UPDATES = ["message", "callback_query", "chat_join_request", "chat_member", "my_chat_member"]
+
+
+def child_webhook_url(tenant_id: int, secret: str) -> str:
+    return f"{settings.WEB_BASE}/webhook/child/{tenant_id}/{secret}"
+
 
-async def set_child_webhook(bot: Bot, tenant_id: int, secret: str):
-    cert = FSInputFile(CERT_PATH)
+async def set_child_webhook(bot: Bot, tenant_id: int, secret: str, drop_pending_updates: bool = True):
     await bot.set_webhook(
-        url=f"{settings.WEB_BASE}/webhook/child/{tenant_id}/{secret}",
-        drop_pending_updates=True,
-        allowed_updates=["message","callback_query","chat_join_request","chat_member","my_chat_member"],
-        certificate=cert,
+        url=child_webhook_url(tenant_id, secret),
+        drop_pending_updates=drop_pending_updates,
+        allowed_updates=ALLOWED_UPDATES,
+        certificate=load_certificate(),
     )
+
+
+# ===== массовая пересинхронизация =====
+
+_RESYNC_PAGE = 500
+
+_RECORD_SQL = """
+UPDATE tenants t SET webhook_url = u.url, webhook_error = u.err
+FROM unnest($1::int[], $2::text[], $3::text[]) AS u(id, url, err)
+WHERE t.id = u.id
+"""
+
+_resync_lock = asyncio.Lock()
+
+
+def resync_running() -> bool:
+    return _resync_lock.locked()
+
+
+async def _sync_one(
+    bucket: TokenBucket, row, cert, force: bool,
+) -> Tuple[str, Optional[str], Optional[str]]:
+    """-> (исход, webhook_url, ошибка); исход: updated / skipped / failed."""
+    tenant_id = int(row["id"])
+    url = child_webhook_url(tenant_id, row["secret"])
+    bot = child_bots.get(tenant_id, row["bot_token"])
+    try:
+        # смену самого сертификата getWebhookInfo не покажет — для неё force
+        if not force:
+            info = await tg_call(bucket, bot.get_webhook_info)
+            if (
+                info.url == url
+                and bool(info.has_custom_certificate) == (cert is not None)
+                and set(info.allowed_updates or ()) == set(ALLOWED_UPDATES)
+            ):
+                return "skipped", url, None
+        # при пересинхронизации очередь апдейтов не сбрасываем
+        await tg_call(bucket, lambda: set_child_webhook(bot, tenant_id, row["secret"], drop_pending_updates=False))
+        return "updated", url, None
+    except TelegramRetryAfter as e:
+        return "failed", row["webhook_url"], f"retry after {e.retry_after}s"
+    except Exception as e:
+        log.warning("webhook resync: tenant %s failed: %s", tenant_id, e)
+        return "failed", row["webhook_url"], f"{type(e).__name__}: {e}"[:500]
+
+
+async def resync_webhooks(force: bool = False) -> Dict[str, int]:
+    """
+    Переустанавливает вебхуки всем активным тенантам. Тенанты читаются страницами
+    по id, вызовы идут параллельно (WEBHOOK_RESYNC_CONCURRENCY) под общим лимитом
+    WEBHOOK_RESYNC_RATE запросов/сек; где getWebhookInfo уже совпадает — пропускаем,
+    с force — ставим всем (после замены сертификата). Сертификат перечитывается
+    с диска на каждый запуск. Результат пишется в tenants.webhook_url / webhook_error.
+    """
+    counts = {"total": 0, "updated": 0, "skipped": 0, "failed": 0}
+    async with _resync_lock:
+        cert = load_certificate(reload=True)
+        bucket = TokenBucket(settings.WEBHOOK_RESYNC_RATE)
+        sem = asyncio.Semaphore(settings.WEBHOOK_RESYNC_CONCURRENCY)
+
+        async def one(row):
+            async with sem:
+                return await _sync_one(bucket, row, cert, force)
+
+        last_id = 0
+        while True:
+            async with pg() as conn:
+                rows = await conn.fetch(
+                    "SELECT id, bot_token, secret, webhook_url FROM tenants "
+                    "WHERE is_active AND id > $1 ORDER BY id LIMIT $2",
+                    last_id, _RESYNC_PAGE,
+                )
+            if not rows:
+                break
+            results = await asyncio.gather(*(one(r) for r in rows))
+
+            ids: List[int] = []
+            urls: List[Optional[str]] = []
+            errors: List[Optional[str]] = []
+            for r, (outcome, url, err) in zip(rows, results):
+                counts[outcome] += 1
+                ids.append(int(r["id"]))
+                urls.append(url)
+                errors.append(err)
+            async with pg() as conn:
+                await conn.execute(_RECORD_SQL, ids, urls, errors)
+
+            counts["total"] += len(rows)
+            last_id = int(rows[-1]["id"])
+            if len(rows) < _RESYNC_PAGE:
+                break
+    return counts
@@ -16,5 +16,94 @@ class Settings(BaseSettings):
     USE_WEBHOOK: bool = True
     CERT_PATH: str = "/etc/ssl/certs/multibot.crt"
 
+    # asyncpg-пул (общий на процесс)
+    PG_POOL_MIN: int = 2
+    PG_POOL_MAX: int = 20
+    PG_ACQUIRE_TIMEOUT: float = 10.0
+    PG_POOL_MAX_IDLE: float = 300.0
+
+    # кэш авторизации тенантов для вебхука
+    TENANT_CACHE_TTL: float = 300.0
+    TENANT_CACHE_MAX: int = 50_000
+    TENANT_COUNT_TTL: float = 60.0
+
+    # кэш скомпилированных приветствий/прощаний
+    GREETING_CACHE_TTL: float = 3600.0
+    GREETING_CACHE_MAX: int = 20_000
+
+    # кэш флагов тенанта (tenant_settings)
+    SETTINGS_CACHE_TTL: float = 600.0
+    SETTINGS_CACHE_MAX: int = 50_000
+
+    # шина инвалидации кэшей между воркерами (LISTEN/NOTIFY)
+    CACHE_BUS_ENABLED: bool = True
+    CACHE_BUS_PING: float = 30.0
+    CACHE_BUS_MAX_BACKOFF: float = 60.0
+
+    # рассылки
+    BROADCAST_PAGE_SIZE: int = 100
+    BROADCAST_CONCURRENCY: int = 8
+    BROADCAST_DB_RETRIES: int = 5    # попыток шага с БД, потом рассылка -> failed
+    BROADCAST_LEASE: float = 300.0   # аренда рассылки процессом, продлевается на каждой странице
+
+    # статистика: как часто сбрасывать счётчики в stats_daily
+    STATS_FLUSH_INTERVAL: float = 30.0
+    STATS_CACHE_TTL: float = 60.0
+
+    # кэш проверки членства в приватке (GA)
+    MEMBERSHIP_POSITIVE_TTL: float = 600.0
+    MEMBERSHIP_NEGATIVE_TTL: float = 30.0
+
+    # реестр детских ботов и общая HTTP-сессия к api.telegram.org
+    CHILD_BOTS_MAX: int = 2000
+    CHILD_BOTS_IDLE_TTL: float = 1800.0
+    TG_HTTP_LIMIT: int = 200
+    TG_HTTP_LIMIT_PER_HOST: int = 100
+    TG_HTTP_KEEPALIVE: float = 30.0
+
+    # лимиты Bot API на одного бота (запросов/сек) и параллельность «Собрать заявки»
+    TG_APPROVE_RATE: float = 25.0
+    TG_DM_RATE: float = 25.0
+    APPROVE_CONCURRENCY: int = 8
+    DM_CONCURRENCY: int = 8
+    # пакетная запись статусов pending_requests
+    PENDING_FLUSH_SIZE: int = 200
+    PENDING_FLUSH_INTERVAL: float = 2.0
+
+    # приём апдейтов: "inline" — обрабатываем до ответа, "queue" — сразу 200, обработка воркерами
+    INGEST_MODE: str = "inline"
+    INGEST_WORKERS_PER_TENANT: int = 4
+    INGEST_QUEUE_SIZE: int = 200
+    INGEST_IDLE_TIMEOUT: float = 60.0
+
+    # FSM: сколько живёт простаивающее состояние, потолок ключей, снимок в Postgres
+    FSM_TTL: float = 6 * 3600
+    FSM_MAX_KEYS: int = 100_000
+    FSM_SNAPSHOT: bool = False
+    FSM_SNAPSHOT_INTERVAL: float = 10.0
+
+    # многопроцессный режим детских ботов: 0 — всё в одном процессе
+    CHILD_WORKERS: int = 0
+    CHILD_WORKER_QUEUE: int = 1000
+    CHILD_WORKER_VNODES: int = 160
+    CHILD_WORKERS_MAX: int = 32       # верхняя граница для /workers N
+
+    # long polling детских ботов (USE_WEBHOOK=False)
+    POLL_CONCURRENCY: int = 100
+    POLL_TIMEOUT: int = 25
+    POLL_HOT_WINDOW: float = 300.0
+    POLL_IDLE_MIN: float = 2.0
+    POLL_IDLE_MAX: float = 120.0
+    POLL_OFFSET_FLUSH: float = 5.0
+    POLL_REFRESH: float = 60.0
+
+    # массовая переустановка вебхуков: общий лимит запросов/сек и параллельность
+    WEBHOOK_RESYNC_RATE: float = 20.0
+    WEBHOOK_RESYNC_CONCURRENCY: int = 20
+
+    # прогрев кэшей на старте: тенантов на один пакет запросов
+    PREWARM_ENABLED: bool = True
+    PREWARM_PAGE: int = 5000
+
 settings = Settings()
 ADMIN_IDS = {int(x.strip()) for x in settings.GA_ADMIN_IDS.split(",") if x.strip()}
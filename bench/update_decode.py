@@ -0,0 +1,75 @@
+"""
+Микробенчмарк разбора апдейта вебхуком: CPU на один апдейт.
+
+  old  — json.loads + Update.model_validate (как было: request.json() + валидация)
+  fast — UpdateDecoder: orjson + отсев ненужных типов до pydantic
+
+Запуск из корня репозитория:  python -m bench.update_decode [N]
+"""
+import json
+import sys
+import time
+
+from aiogram.types import Update
+
+from app.bots.ingest import UpdateDecoder
+from app.routers.child_webhook import dp
+
+_USER = {"id": 111222333, "is_bot": False, "first_name": "Ivan", "username": "ivan", "language_code": "ru"}
+_CHAT = {"id": -1001234567890, "title": "Channel", "type": "channel"}
+
+SAMPLES = {
+    "chat_join_request": {
+        "update_id": 1,
+        "chat_join_request": {"chat": _CHAT, "from": _USER, "user_chat_id": _USER["id"], "date": 1700000000},
+    },
+    "message": {
+        "update_id": 2,
+        "message": {
+            "message_id": 10, "date": 1700000000, "text": "/admin",
+            "chat": {"id": _USER["id"], "type": "private", "first_name": "Ivan"}, "from": _USER,
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    },
+    # нет хендлера в детском диспетчере — быстрый путь отвечает без pydantic
+    "my_chat_member": {
+        "update_id": 3,
+        "my_chat_member": {
+            "chat": _CHAT, "from": _USER, "date": 1700000000,
+            "old_chat_member": {"status": "left", "user": _USER},
+            "new_chat_member": {"status": "administrator", "user": _USER, "can_be_edited": False,
+                                "is_anonymous": False, "can_manage_chat": True, "can_delete_messages": True,
+                                "can_manage_video_chats": True, "can_restrict_members": True,
+                                "can_promote_members": False, "can_change_info": True,
+                                "can_invite_users": True, "can_post_messages": True,
+                                "can_edit_messages": True, "can_post_stories": False,
+                                "can_edit_stories": False, "can_delete_stories": False},
+        },
+    },
+}
+
+
+def _old(raw: bytes) -> None:
+    Update.model_validate(json.loads(raw))
+
+
+def _bench(fn, raw: bytes, n: int) -> float:
+    start = time.process_time()
+    for _ in range(n):
+        fn(raw)
+    return (time.process_time() - start) / n * 1e6
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    decoder = UpdateDecoder(dp)
+    print(f"{'update':<20}{'old, µs':>10}{'fast, µs':>10}{'x':>7}")
+    for name, payload in SAMPLES.items():
+        raw = json.dumps(payload).encode()
+        old = _bench(_old, raw, n)
+        fast = _bench(decoder.decode, raw, n)
+        print(f"{name:<20}{old:>10.1f}{fast:>10.1f}{old / fast:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
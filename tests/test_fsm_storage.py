@@ -0,0 +1,91 @@
+"""
+CompactStorage со снимком: локальные изменения поверх ключей, которые уже лежат
+в fsm_state. БД подменяется словарём строк снимка.
+"""
+import asyncio
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+
+from app.bots.fsm_storage import CompactStorage, _Record, _compact, _db_key
+
+KEY = StorageKey(bot_id=1, chat_id=10, user_id=10)
+STATE = "BroadcastStates:waiting_message"
+
+
+def _snapshotted_storage(rows):
+    storage = CompactStorage(ttl=3600, max_keys=100, snapshot=True)
+    storage._remote_keys = set(rows)
+
+    async def load_one(k):
+        row = rows.get(_db_key(k))
+        return _Record(*row) if row else None
+
+    storage._load_one = load_one
+    return storage
+
+
+def test_clear_after_snapshot_does_not_resurrect_state():
+    db_key = _db_key(_compact(KEY))
+    storage = _snapshotted_storage({db_key: (STATE, None)})
+    ctx = FSMContext(storage, KEY)
+
+    async def run():
+        assert await ctx.get_state() == STATE
+        await ctx.clear()
+        assert await ctx.get_state() is None
+        assert await ctx.get_data() == {}
+
+    asyncio.run(run())
+    # до снимка строка в БД ещё есть — снимок должен её удалить, а не переписать
+    assert db_key in storage._deleted
+    assert not any(r.dirty for r in storage._records.values())
+
+
+def test_set_after_clear_keeps_new_state():
+    db_key = _db_key(_compact(KEY))
+    storage = _snapshotted_storage({db_key: (STATE, {"step": 1})})
+    ctx = FSMContext(storage, KEY)
+
+    async def run():
+        await ctx.clear()
+        await ctx.set_state("Other:state")
+        assert await ctx.get_state() == "Other:state"
+        assert await ctx.get_data() == {}
+
+    asyncio.run(run())
+    assert db_key not in storage._deleted
+
+
+def test_remote_snapshot_refreshes_clean_copy():
+    db_key = _db_key(_compact(KEY))
+    rows = {db_key: (STATE, None)}
+    storage = _snapshotted_storage(rows)
+    ctx = FSMContext(storage, KEY)
+
+    async def run():
+        assert await ctx.get_state() == STATE
+        # другой процесс сбросил состояние и записал снимок
+        del rows[db_key]
+        storage.apply_remote([], [db_key])
+        assert await ctx.get_state() is None
+        # и снова выставил — ключ узнаём из уведомления, строку читаем из БД
+        rows[db_key] = ("Other:state", {"step": 2})
+        storage.apply_remote([db_key], [])
+        assert await ctx.get_state() == "Other:state"
+        assert await ctx.get_data() == {"step": 2}
+
+    asyncio.run(run())
+
+
+def test_remote_snapshot_keeps_unsaved_local_changes():
+    db_key = _db_key(_compact(KEY))
+    storage = _snapshotted_storage({db_key: (STATE, None)})
+    ctx = FSMContext(storage, KEY)
+
+    async def run():
+        await ctx.set_state("Local:state")
+        storage.apply_remote([db_key], [])
+        assert await ctx.get_state() == "Local:state"
+
+    asyncio.run(run())
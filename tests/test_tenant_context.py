@@ -0,0 +1,64 @@
+"""
+Стресс-проверка TenantContext: много тенантов, апдейты вперемешку и
+параллельно — хендлер должен видеть в current_tenant ровно того тенанта,
+с которым пришёл его апдейт.
+"""
+import asyncio
+import random
+
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import Update
+
+from app.bots.middlewares.tenant_ctx import TenantContext, current_tenant
+
+TENANTS = 50
+UPDATES = 3000
+
+
+def _update(update_id: int, chat_id: int) -> Update:
+    return Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "u"},
+            "text": "hi",
+        },
+    })
+
+
+def test_no_tenant_bleed_under_interleaved_updates():
+    router = Router()
+    mismatches = []
+    handled = []
+
+    @router.message()
+    async def handler(message, tenant):
+        # переключаемся на другие апдейты посреди обработки
+        await asyncio.sleep(random.random() / 1000)
+        seen = current_tenant.get()
+        if seen is not tenant:
+            mismatches.append((tenant["id"], seen and seen["id"]))
+        handled.append(tenant["id"])
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    dp.update.middleware(TenantContext())
+
+    async def run():
+        bot = Bot("42:TEST")
+        tenants = [{"id": i, "owner_user_id": 1000 + i} for i in range(TENANTS)]
+        rnd = random.Random(5)
+        jobs = []
+        for n in range(UPDATES):
+            tenant = rnd.choice(tenants)
+            jobs.append(dp.feed_update(bot, _update(n, 10_000 + n % 97), tenant=tenant))
+        await asyncio.gather(*jobs)
+        await bot.session.close()
+        # после обработки контекст не протекает наружу
+        assert current_tenant.get() is None
+
+    asyncio.run(run())
+    assert len(handled) == UPDATES
+    assert mismatches == []